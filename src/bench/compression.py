@@ -0,0 +1,110 @@
+"""Compare permessage-deflate settings on representative chat traffic.
+
+Encodes a stream of real packets (single messages, batches and history pages) through the same
+permessage-deflate implementation the server uses, once per setting, and reports the CPU spent
+compressing and decompressing against the bytes saved. Compression runs once per receiving connection,
+so multiply the per-frame cost by the audience of a broadcast.
+
+Run from the repository root:
+    PYTHONPATH=src python src/bench/compression.py --frames 20000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from loguru import logger
+from SCPC.util import packets
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+from websockets.frames import Frame, Opcode
+from common import schema, transport
+from loadgen import ROOT, git_commit
+
+WORDS = ("the", "a", "is", "it", "to", "and", "of", "you", "that", "in", "lol", "ok", "yes", "no", "what", "anyone",
+         "here", "server", "channel", "message", "tonight", "game", "build", "broken", "fixed", "thanks", "hello",
+         "deploy", "test", "again", "why", "does", "this", "work", "now", "later", "maybe", "sure", "link", "check")
+
+def chat_line(rng: random.Random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 16)))
+
+def traffic(count: int, seed: int = 0) -> list[bytes]:
+    """Encoded clientbound frames in roughly the mix a busy lobby produces"""
+    rng = random.Random(seed)
+    nicks = [f"user{i}" for i in range(50)]
+    batch_spec = schema.load()["clientbound"]["recieve_message"]
+    frames = []
+    for seq in range(count):
+        roll = rng.random()
+        if roll < 0.7:
+            packet = packets.clientbound.recieve_message(channel="", nickname=rng.choice(nicks), content=chat_line(rng))
+        elif roll < 0.9:
+            records = [schema.batch_record(packets.clientbound.recieve_message(channel="#dev", nickname=rng.choice(nicks), content=chat_line(rng)), batch_spec)
+                       for _ in range(rng.randint(2, 32))]
+            packet = packets.clientbound.batch(events=schema.RECORD_SEP.join(records))
+        else:
+            packet = packets.clientbound.history(seq=seq, timestamp=1700000000 + seq, kind=0, nickname=rng.choice(nicks), target="", content=chat_line(rng))
+        frames.append(packet.encode())
+    return frames
+
+def measure(frames: list[bytes], window_bits: int | None, mem_level: int | None) -> dict:
+    """Push frames through one sender/receiver pair. window_bits=None measures an uncompressed connection."""
+    raw = sum(len(i) for i in frames)
+    if window_bits is None:
+        return {"compression": "none", "raw_bytes": raw, "wire_bytes": raw, "ratio": 1.0, "saved_bytes": 0,
+                "encode_us_per_frame": 0.0, "decode_us_per_frame": 0.0, "memory_per_connection": 0}
+
+    settings = {"memLevel": mem_level}
+    sender = PerMessageDeflate(False, False, window_bits, window_bits, settings)
+    receiver = PerMessageDeflate(False, False, window_bits, window_bits, settings)
+
+    start = time.process_time()
+    encoded = [sender.encode(Frame(Opcode.BINARY, data)) for data in frames]
+    encode_s = time.process_time() - start
+
+    start = time.process_time()
+    for frame in encoded:
+        receiver.decode(frame)
+    decode_s = time.process_time() - start
+
+    wire = sum(len(i.data) for i in encoded)
+    return {"compression": "deflate", "window_bits": window_bits, "mem_level": mem_level,
+            "raw_bytes": raw, "wire_bytes": wire, "ratio": round(wire / raw, 4), "saved_bytes": raw - wire,
+            "encode_us_per_frame": round(encode_s / len(frames) * 1e6, 2),
+            "decode_us_per_frame": round(decode_s / len(frames) * 1e6, 2),
+            "memory_per_connection": transport.deflate_memory(window_bits, mem_level)}
+
+def main():
+    parser = argparse.ArgumentParser(description="permessage-deflate settings benchmark")
+    parser.add_argument("--frames", type=int, default=20000, help="Frames sent over each simulated connection")
+    parser.add_argument("--window-bits", type=int, nargs='+', default=[9, 10, 12, 15], help="Deflate window sizes to try")
+    parser.add_argument("--mem-levels", type=int, nargs='+', default=[1, 5, 8], help="zlib memLevels to try")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON results path (default: data/bench/compression-<commit>-<time>.json)")
+    args = parser.parse_args()
+
+    packets.init(os.path.join(ROOT, "etc", "cfg", "packets.kdl"))
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+
+    frames = traffic(args.frames, args.seed)
+    report = [measure(frames, None, None)]
+    for window_bits in args.window_bits:
+        for mem_level in args.mem_levels:
+            report.append(measure(frames, window_bits, mem_level))
+
+    print(f"{'setting':<16}{'ratio':>8}{'saved':>12}{'enc us':>9}{'dec us':>9}{'mem KiB':>9}")
+    for row in report:
+        name = f"w{row['window_bits']} m{row['mem_level']}" if row["compression"] == "deflate" else "none"
+        print(f"{name:<16}{row['ratio']:>8.3f}{row['saved_bytes']:>12}{row['encode_us_per_frame']:>9.2f}"
+              f"{row['decode_us_per_frame']:>9.2f}{row['memory_per_connection'] // 1024:>9}")
+
+    result = {"commit": git_commit(), "timestamp": int(time.time()), "params": vars(args), "results": report}
+    output = args.output or os.path.join(ROOT, "data", "bench", f"compression-{result['commit'] or 'unknown'}-{result['timestamp']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as outfile:
+        json.dump(result, outfile, indent=2)
+    logger.info("Results written to {}", output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""End-to-end load generator for the chat server.
+
+Starts server.main() in a child process (in a scratch directory, with rate limits off), drives simulated
+clients against it using the real packets from etc/cfg/packets.kdl and writes the results as JSON so runs
+can be compared across commits.
+
+Run from the repository root:
+    PYTHONPATH=src python src/bench/loadgen.py --clients 1000 --senders 50 --messages 20
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import websockets
+from loguru import logger
+from SCPC.util import packets
+from common import schema
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+def percentiles(samples: list[float]) -> dict:
+    """p50/p99/p999/max of samples (in ms)"""
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {"count": len(samples), "p50": pick(0.5), "p99": pick(0.99), "p999": pick(0.999), "max": samples[-1]}
+
+def rss_kib(pid: int) -> int:
+    """Resident memory of pid in KiB (Linux only, 0 elsewhere)"""
+    try:
+        with open(f"/proc/{pid}/status") as infile:
+            for line in infile:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def run_server(port: int, workdir: str, overrides: dict):
+    """Child process: run the real server out of a scratch directory (PYCHAT_ROOT) so benchmarks don't touch data/"""
+    os.chdir(workdir)
+    sys.path[:0] = [os.path.join(ROOT, "src", "server"), os.path.join(ROOT, "src")]
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    import server
+    server.SERVER_ADDRESS = "127.0.0.1"
+    server.SERVER_PORT = port
+    server.CONNECTION_LIMIT, server.PACKET_LIMITS, server.global_bucket = None, {}, None
+    server.METRICS_PORT = 0 # don't clash with a dev server's metrics endpoint
+    for name, value in overrides.items():
+        setattr(server, name, value)
+    asyncio.run(server.main())
+
+class SimClient:
+    """One simulated user. Records delivery latency of timestamped messages it receives."""
+    def __init__(self, url: str, nick: str, results: "Results"):
+        self.url = url
+        self.nick = nick
+        self.results = results
+        self.conn = None
+        self.responses = asyncio.Queue()
+        self.lock = asyncio.Lock() # one request in flight at a time, so responses pair up
+        self.batch_specs = schema.inbound("clientbound")
+        self.token = None # session token from the last login
+        self._task = None
+
+    async def open(self):
+        self.conn = await websockets.connect(self.url, max_queue=None)
+        self._task = asyncio.create_task(self._receive())
+
+    async def request(self, packet: packets.Packet) -> tuple[int, str]:
+        """Send a packet that expects a response and wait for it"""
+        async with self.lock:
+            await self.conn.send(packet.encode())
+            return await self.responses.get()
+
+    async def _receive(self):
+        try:
+            async for frame in self.conn:
+                packet = packets.decode(frame)
+                match packet.type_name:
+                    case "response":
+                        self.responses.put_nowait((packet.value, packet.content))
+                    case "session":
+                        self.token = packet.token
+                    case "keep_alive": # answer so long runs aren't reaped as dead
+                        await self.conn.send(packets.twoway.response(value=0, content=str(packet.timestamp)).encode())
+                    case "recieve_message" | "direct_message":
+                        self.results.record_delivery(packet.type_name, packet.content)
+                    case "batch":
+                        for spec, fields in schema.split_batch(packet.events, self.batch_specs):
+                            if spec.name == "recieve_message":
+                                self.results.record_delivery(spec.name, fields["content"])
+        except websockets.ConnectionClosed:
+            pass
+
+    async def close(self):
+        await self.conn.close()
+        if self._task:
+            await self._task
+
+class Results:
+    def __init__(self):
+        self.latency = {"recieve_message": [], "direct_message": []}
+        self.delivered = 0
+
+    def record_delivery(self, kind: str, content: str):
+        stamp, _, _ = content.partition(' ')
+        if stamp.isdigit():
+            self.latency[kind].append((time.time_ns() - int(stamp)) / 1e6)
+            self.delivered += 1
+
+def stamped(seq: int) -> str:
+    return f"{time.time_ns()} {seq}"
+
+async def timed(coro) -> float:
+    start = time.perf_counter()
+    await coro
+    return (time.perf_counter() - start) * 1000
+
+async def connect_storm(url: str, count: int, results: Results, concurrency: int, features: int = 0) -> tuple[list[SimClient], dict]:
+    """Open count connections and send connect on each, at most concurrency at a time"""
+    sem = asyncio.Semaphore(concurrency)
+    connect_ms = []
+    clients = [SimClient(url, f"bench{i}", results) for i in range(count)]
+
+    async def join(client: SimClient):
+        async with sem:
+            start = time.perf_counter()
+            await client.open()
+            value, content = await client.request(packets.serverbound.connect(nickname=client.nick, features=features))
+            if value:
+                raise RuntimeError(f"connect failed for {client.nick}: {content}")
+            connect_ms.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(join(i) for i in clients))
+    elapsed = time.perf_counter() - start
+    return clients, {"clients": count, "seconds": elapsed, "per_second": count / elapsed, "latency_ms": percentiles(connect_ms)}
+
+async def message_flood(clients: list[SimClient], results: Results, senders: int, messages: int, settle: float) -> dict:
+    """senders clients each send messages timestamped broadcasts. Every client measures delivery latency."""
+    results.latency["recieve_message"].clear()
+    results.delivered = 0
+    expected = senders * messages * len(clients)
+
+    async def send(client: SimClient):
+        for seq in range(messages):
+            await client.request(packets.serverbound.send_message(channel="", content=stamped(seq)))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(i) for i in clients[:senders]))
+    deadline = time.perf_counter() + settle
+    while results.delivered < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    return {"sent": senders * messages, "expected_deliveries": expected, "deliveries": results.delivered,
+            "seconds": elapsed, "deliveries_per_second": results.delivered / elapsed,
+            "latency_ms": percentiles(results.latency["recieve_message"])}
+
+async def dm_flood(clients: list[SimClient], results: Results, count: int) -> dict:
+    """Send count DMs between random pairs"""
+    results.latency["direct_message"].clear()
+    rtt = []
+
+    async def send(client: SimClient, target: SimClient):
+        rtt.append(await timed(client.request(packets.serverbound.direct_message(target=target.nick, content=stamped(0)))))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(random.choice(clients), random.choice(clients)) for _ in range(count)))
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0.2)
+    return {"sent": count, "seconds": elapsed, "per_second": count / elapsed, "response_ms": percentiles(rtt),
+            "latency_ms": percentiles(results.latency["direct_message"])}
+
+async def command_flood(clients: list[SimClient], count: int) -> dict:
+    rtt = []
+
+    async def send(client: SimClient):
+        rtt.append(await timed(client.request(packets.serverbound.command(keyword="list", args=""))))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(random.choice(clients)) for _ in range(count)))
+    elapsed = time.perf_counter() - start
+    return {"sent": count, "seconds": elapsed, "per_second": count / elapsed, "response_ms": percentiles(rtt)}
+
+async def login_storm(url: str, count: int, results: Results) -> dict:
+    """Register count fresh accounts and log each one in on its own connection, then reconnect them all
+    and resume their sessions as after a server deploy"""
+    clients = [SimClient(url, f"login{i}", results) for i in range(count)]
+    await asyncio.gather(*(i.open() for i in clients))
+    register_ms, login_ms = [], []
+
+    async def auth(client: SimClient):
+        register_ms.append(await timed(client.request(packets.serverbound.register(username=client.nick, password="benchmark"))))
+        login_ms.append(await timed(client.request(packets.serverbound.login(username=client.nick, password="benchmark"))))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(auth(i) for i in clients))
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*(i.close() for i in clients))
+
+    resume_ms = []
+    async def resume(client: SimClient):
+        await client.open()
+        resume_ms.append(await timed(client.request(packets.serverbound.resume(token=client.token))))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(resume(i) for i in clients if i.token))
+    resume_elapsed = time.perf_counter() - start
+    await asyncio.gather(*(i.close() for i in clients))
+    return {"accounts": count, "seconds": elapsed, "logins_per_second": count / elapsed,
+            "register_ms": percentiles(register_ms), "login_ms": percentiles(login_ms),
+            "resumes_per_second": len(resume_ms) / resume_elapsed, "resume_ms": percentiles(resume_ms)}
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+async def bench(args, url: str, server_pid: int) -> dict:
+    results = Results()
+    report = {}
+    await asyncio.sleep(0) # let the event loop start before timing anything
+
+    base_rss = rss_kib(server_pid)
+    clients, report["connect_storm"] = await connect_storm(url, args.clients, results, args.concurrency, 1 if args.batch else 0)
+    await asyncio.sleep(0.5)
+    idle_rss = rss_kib(server_pid)
+    report["memory"] = {"base_rss_kib": base_rss, "rss_kib": idle_rss,
+                        "kib_per_connection": (idle_rss - base_rss) / max(1, args.clients)}
+
+    report["send_message"] = await message_flood(clients, results, min(args.senders, args.clients), args.messages, args.settle)
+    report["direct_message"] = await dm_flood(clients, results, args.dms)
+    report["command"] = await command_flood(clients, args.commands)
+    if args.logins:
+        report["login"] = await login_storm(url, args.logins, results)
+
+    report["memory"]["active_rss_kib"] = rss_kib(server_pid)
+    await asyncio.gather(*(i.close() for i in clients))
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server load generator")
+    parser.add_argument("--clients", type=int, default=1000, help="Connected clients")
+    parser.add_argument("--concurrency", type=int, default=200, help="Connections opened at once during the connect storm")
+    parser.add_argument("--senders", type=int, default=20, help="Clients sending broadcast messages")
+    parser.add_argument("--messages", type=int, default=20, help="Messages per sender")
+    parser.add_argument("--dms", type=int, default=2000, help="Direct messages sent between random clients")
+    parser.add_argument("--commands", type=int, default=1000, help="Commands sent")
+    parser.add_argument("--logins", type=int, default=20, help="Accounts registered and logged in (0 to skip)")
+    parser.add_argument("--batch", action="store_true", help="Ask the server for batched delivery when connecting")
+    parser.add_argument("--settle", type=float, default=30, help="Seconds to wait for outstanding deliveries")
+    parser.add_argument("--output", default=None, help="JSON results path (default: data/bench/<commit>-<time>.json)")
+    args = parser.parse_args()
+
+    packets.init(os.path.join(ROOT, "etc", "cfg", "packets.kdl"))
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+
+    workdir = tempfile.mkdtemp(prefix="pychat-bench-")
+    os.symlink(os.path.join(ROOT, "etc"), os.path.join(workdir, "etc"))
+    os.mkdir(os.path.join(workdir, "data"))
+
+    port = free_port()
+    os.environ["PYCHAT_ROOT"] = workdir # inherited by the server process
+    proc = multiprocessing.get_context("spawn").Process(target=run_server, args=(port, workdir, {}), daemon=True)
+    proc.start()
+    url = f"ws://127.0.0.1:{port}"
+    try:
+        for _ in range(100): # wait for the server to listen
+            try:
+                socket.create_connection(("127.0.0.1", port), 0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        report = asyncio.run(bench(args, url, proc.pid))
+    finally:
+        proc.terminate()
+        proc.join(5)
+
+    result = {"commit": git_commit(), "timestamp": int(time.time()), "params": vars(args), "results": report}
+    output = args.output or os.path.join(ROOT, "data", "bench", f"{result['commit'] or 'unknown'}-{result['timestamp']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as outfile:
+        json.dump(result, outfile, indent=2)
+
+    print(json.dumps(report, indent=2))
+    logger.info("Results written to {}", output)
+
+if __name__ == "__main__":
+    main()
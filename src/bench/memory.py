@@ -0,0 +1,204 @@
+"""Server memory per connection.
+
+For each connection count a fresh server is started (as in loadgen.py) and that many connections are
+opened from worker processes. The growth of the server's resident memory is reported per connection:
+    idle    connected with a nickname, nothing sent
+    active  every connection is in a channel of --room-size members and sends a message about every
+            --interval seconds; the highest RSS seen over --duration seconds
+
+Connections negotiate the same permessage-deflate window as real clients, but the benchmark's own
+compressors use the smallest memLevel so tens of thousands of connections fit in the worker processes.
+The open file limit is raised to the hard limit, as the server needs a descriptor per connection.
+
+Run from the repository root:
+    PYTHONPATH=src python src/bench/memory.py --counts 1000 10000 50000
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+import kdl
+import websockets
+from loguru import logger
+from SCPC.util import packets
+from common import paths, transport
+from common.gen_utils import config_section
+from compression import chat_line
+from loadgen import ROOT, free_port, git_commit, rss_kib, run_server
+
+def raise_fd_limit() -> int:
+    """Raise the open file limit to the hard limit (inherited by the processes started afterwards)"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+def client_options() -> dict:
+    """Transport options with the server's window (so the server keeps the same state as for a real client)"""
+    with open(paths.CONFIG_PATH, 'r') as infile:
+        cfg = kdl.parse(infile.read())
+    props = config_section(cfg, "server", "transport")
+    return transport.options({**props, "mem_level": 1, "max_size": 0}, server=False)
+
+def run_connections(url: str, first: int, count: int, room_size: int, interval: float, pipe):
+    """Worker process: hold count connections and follow the commands sent by the parent over pipe"""
+    packets.init(paths.PACKETS_PATH)
+    asyncio.run(connections(url, first, count, room_size, interval, pipe))
+
+async def connections(url: str, first: int, count: int, room_size: int, interval: float, pipe):
+    options = client_options()
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(100)
+    conns = {} # number: connection
+    readers = []
+
+    async def drain(conn: websockets.ClientConnection):
+        try:
+            async for _ in conn:
+                pass
+        except websockets.ConnectionClosed:
+            pass
+
+    async def open_one(number: int):
+        async with sem:
+            for attempt in range(3): # handshakes time out when the machine is saturated by its own benchmark
+                try:
+                    conn = await websockets.connect(url, open_timeout=60, **{**options, "max_queue": None})
+                    await conn.send(packets.serverbound.connect(nickname=f"mem{number}", features=1).encode())
+                    await conn.recv()
+                    break
+                except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+                    error = e
+            else:
+                logger.warning("Connection {} failed: {}", number, error)
+                return
+            conns[number] = conn
+            readers.append(asyncio.create_task(drain(conn)))
+
+    async def talk(number: int, conn: websockets.ClientConnection):
+        await conn.send(packets.serverbound.join(channel=f"#room{number // room_size}").encode())
+        rng = random.Random(number)
+        while True:
+            await asyncio.sleep(interval * rng.uniform(0.5, 1.5))
+            await conn.send(packets.serverbound.send_message(channel=f"#room{number // room_size}", content=chat_line(rng)).encode())
+
+    await asyncio.gather(*(open_one(i) for i in range(first, first + count)))
+    pipe.send(len(conns))
+    talkers = []
+    while True:
+        command = await loop.run_in_executor(None, pipe.recv)
+        if command == "active":
+            talkers = [asyncio.create_task(talk(number, conn)) for number, conn in conns.items()]
+            pipe.send(True)
+        elif command == "close":
+            for task in talkers:
+                task.cancel()
+            await asyncio.gather(*(conn.close() for conn in conns.values()), return_exceptions=True)
+            await asyncio.gather(*readers)
+            pipe.send(True)
+            return
+
+def measure(count: int, args, workdir: str) -> dict:
+    """Start a server, open count connections, and report its RSS idle and under traffic"""
+    port = free_port()
+    spawn = multiprocessing.get_context("spawn")
+    server = spawn.Process(target=run_server, args=(port, workdir, {}), daemon=True)
+    server.start()
+    url = f"ws://127.0.0.1:{port}"
+    workers = []
+    try:
+        for _ in range(100): # wait for the server to listen
+            try:
+                socket.create_connection(("127.0.0.1", port), 0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        time.sleep(args.settle) # background startup (databases) shouldn't count as connection memory
+        base = rss_kib(server.pid)
+
+        start = time.perf_counter()
+        for first in range(0, count, args.per_process):
+            parent, child = spawn.Pipe()
+            process = spawn.Process(target=run_connections, daemon=True,
+                                    args=(url, first, min(args.per_process, count - first), args.room_size, args.interval, child))
+            process.start()
+            workers.append((process, parent))
+        connected = sum(pipe.recv() for _, pipe in workers)
+        connect_seconds = time.perf_counter() - start
+        time.sleep(args.settle)
+        idle = rss_kib(server.pid)
+
+        for _, pipe in workers:
+            pipe.send("active")
+        for _, pipe in workers:
+            pipe.recv()
+        active = idle
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            time.sleep(0.5)
+            active = max(active, rss_kib(server.pid))
+
+        for _, pipe in workers:
+            pipe.send("close")
+        for _, pipe in workers:
+            pipe.recv()
+        time.sleep(args.settle)
+        closed = rss_kib(server.pid)
+    finally:
+        for process, _ in workers:
+            process.terminate()
+        server.terminate()
+        server.join(5)
+
+    per = lambda kib: round((kib - base) / max(1, connected), 2)
+    return {"connections": connected, "connect_seconds": round(connect_seconds, 2), "base_rss_kib": base,
+            "idle_rss_kib": idle, "active_rss_kib": active, "closed_rss_kib": closed,
+            "idle_kib_per_connection": per(idle), "active_kib_per_connection": per(active)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server memory per connection")
+    parser.add_argument("--counts", type=int, nargs="+", default=[1000, 10000, 50000], help="Connection counts to measure")
+    parser.add_argument("--per-process", type=int, default=5000, help="Connections held by each worker process")
+    parser.add_argument("--room-size", type=int, default=20, help="Members per channel in the active phase")
+    parser.add_argument("--interval", type=float, default=5, help="Seconds between messages from one connection in the active phase")
+    parser.add_argument("--duration", type=float, default=15, help="Seconds of active traffic")
+    parser.add_argument("--settle", type=float, default=2, help="Seconds to wait before each measurement")
+    parser.add_argument("--output", default=None, help="JSON results path (default: data/bench/memory-<commit>-<time>.json)")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+    fd_limit = raise_fd_limit()
+    if max(args.counts) + 100 > fd_limit:
+        logger.warning("Open file limit is {}, too low for {} connections", fd_limit, max(args.counts))
+
+    workdir = tempfile.mkdtemp(prefix="pychat-bench-")
+    os.symlink(os.path.join(ROOT, "etc"), os.path.join(workdir, "etc"))
+    os.mkdir(os.path.join(workdir, "data"))
+    os.environ["PYCHAT_ROOT"] = workdir # inherited by the server process
+
+    report = {}
+    for count in args.counts:
+        logger.info("Measuring {} connections", count)
+        report[str(count)] = measure(count, args, workdir)
+        logger.info("{} connections: {} KiB idle, {} KiB active per connection", report[str(count)]["connections"],
+                    report[str(count)]["idle_kib_per_connection"], report[str(count)]["active_kib_per_connection"])
+
+    result = {"commit": git_commit(), "timestamp": int(time.time()), "params": vars(args), "results": report}
+    output = args.output or os.path.join(ROOT, "data", "bench", f"memory-{result['commit'] or 'unknown'}-{result['timestamp']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as outfile:
+        json.dump(result, outfile, indent=2)
+
+    print(json.dumps(report, indent=2))
+    logger.info("Results written to {}", output)
+
+if __name__ == "__main__":
+    main()
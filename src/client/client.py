@@ -1,4 +1,8 @@
 import asyncio
+import json
+import os
+from collections import deque
+import time
 import websockets
 from loguru import logger
 import sys
@@ -11,27 +15,98 @@ from SCPC.util import packets
 #import commands
 from common.conn import ConnectionHandler
 import commands
-from common import cmd_utils
+from render import Renderer
+from common import cmd_utils, logs, paths, schema, transport
+from common.roster import Roster, unpack
+from common.gen_utils import config_section
 
-packets.init("etc/cfg/packets.kdl")
+packets.init(paths.PACKETS_PATH)
 
 # Load config file
-with open("etc/cfg/config.kdl", 'r') as _infile:
+with open(paths.CONFIG_PATH, 'r') as _infile:
     client_cfg = kdl.parse(_infile.read())
 
 IP_ADDR = client_cfg["client"]["server"]["ip"].args[0]
 IP_PORT = client_cfg["client"]["server"]["port"].args[0]
+TRANSPORT_OPTIONS = transport.options(config_section(client_cfg, "client", "transport"), server=False)
+_render_cfg = config_section(client_cfg, "client", "render")
+RENDER_FPS = float(_render_cfg.get("fps", 30))
+RENDER_SCROLLBACK = int(_render_cfg.get("scrollback", 1000))
+EVENT_QUEUE_SIZE = int(_render_cfg.get("queue", 1000))
+PRIORITY_PACKETS = ("keep_alive", "response") # handled as soon as they arrive, never queued behind chat traffic
+SKIPPABLE_PACKETS = ("recieve_message", "emote", "connect", "disconnect", "batch") # may be dropped when the event queue is full
+SESSION_CACHE = paths.resolve(config_section(client_cfg, "client", "session").get("cache", "data/session.json"))
 
 DEBUG_ENABLED = False
 # TODO: add to config file
 
+ROSTER_DETAIL = 5 # list names for roster changes up to this size, otherwise just count them
+
+def load_sessions() -> dict:
+    """Cached session tokens: {server url: {"username": ..., "token": ..., "expires": ...}}"""
+    try:
+        with open(SESSION_CACHE, 'r') as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+def save_session(url: str, session: dict | None):
+    """Cache session for url, or forget it if session is None"""
+    sessions = load_sessions()
+    if session is None:
+        sessions.pop(url, None)
+    else:
+        sessions[url] = session
+    os.makedirs(os.path.dirname(SESSION_CACHE) or ".", exist_ok=True)
+    # Tokens are bearer credentials: only the owner may read the file
+    fd = os.open(SESSION_CACHE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.chmod(SESSION_CACHE, 0o600) # also if it was created with the default umask before
+    with os.fdopen(fd, 'w') as outfile:
+        json.dump(sessions, outfile)
+
+def channel_prefix(channel: str) -> str:
+    return f"{Style.DIM}[{channel}]{Style.RESET_ALL} " if channel else ""
+
 class Client(ConnectionHandler):
     """Class to store Client attributes and methods"""
+    __slots__ = ("channel", "pending_command", "pending_resume", "url", "renderer", "events", "events_waiting", "roster", "username", "reconnect_delay")
+    inbound = ("clientbound", "twoway")
+
     def __init__(self, conn: websockets.ClientConnection, nick: str = ""):
         super().__init__(conn, nick)
+        self.channel = "" # channel that plain messages are sent to ("" is the lobby)
+        self.pending_command = False
+        self.pending_resume = False
+        self.url = ""
+        self.renderer = Renderer(RENDER_FPS, RENDER_SCROLLBACK)
+        self.events = deque() # decoded packets waiting to be displayed, None once the connection is done
+        self.events_waiting = asyncio.Event()
+        self.roster = Roster()
+        self.reconnect_delay = None # seconds, if the server is restarting and asked us to come back
+
+    def show(self, text: str):
+        self.renderer.show(text)
+
+    def queue_event(self, packet: packets.Packet | None):
+        """Queue a packet for display_events. During a flood the oldest chat events are dropped, and counted in the
+        renderer's skipped lines, instead of piling up here before the renderer's own limit applies."""
+        if len(self.events) >= EVENT_QUEUE_SIZE:
+            for i, queued in enumerate(self.events):
+                if queued is not None and queued.type_name in SKIPPABLE_PACKETS:
+                    del self.events[i]
+                    self.renderer.skipped += queued.events.count(schema.RECORD_SEP) + 1 if queued.type_name == "batch" else 1
+                    break
+        self.events.append(packet)
+        self.events_waiting.set()
+
+    async def next_event(self) -> packets.Packet | None:
+        while not self.events:
+            self.events_waiting.clear()
+            await self.events_waiting.wait()
+        return self.events.popleft()
 
     async def connect(self, username: str):
-        connect_pkt = packets.serverbound.connect(nickname=username)
+        connect_pkt = packets.serverbound.connect(nickname=username, features=schema.FEATURE_BATCH | schema.FEATURE_PRESENCE)
         await self.send(connect_pkt)
         logger.info("Connected to server as {}", username)
         self.username = username
@@ -47,34 +122,88 @@ class Client(ConnectionHandler):
         logger.info("Logged in")
         self.username = username
 
+    async def resume(self, username: str, token: str):
+        self.pending_resume = True
+        await self.send(packets.serverbound.resume(token=token))
+        logger.info("Resuming session as {}", username)
+        self.username = username
+
     async def disconnect(self, message: str = ""):
         print(1)
         await self.send(packets.serverbound.disconnect(message=message))
         self.is_connected = False
 
     async def p_keep_alive(self, packet: packets.Packet):
-        return (0, "")
+        return (0, str(packet.timestamp)) # echoed so the server can measure the round trip
 
     async def p_recieve_message(self, packet: packets.Packet):
-        print(f"{Fore.CYAN}{packet.nickname}: {Style.RESET_ALL}{packet.content}{Style.RESET_ALL}")
+        self.show(f"{channel_prefix(packet.channel)}{Fore.CYAN}{packet.nickname}: {Style.RESET_ALL}{packet.content}{Style.RESET_ALL}")
 
     async def p_connect(self, packet: packets.Packet):
-        print(f"{Fore.MAGENTA}{packet.nickname} joined the server{(': ' + packet.message) if packet.message else ''}{Style.RESET_ALL}") # message is an optional field containing a join/leave reason
+        self.show(f"{Fore.MAGENTA}{packet.nickname} joined the server{(': ' + packet.message) if packet.message else ''}{Style.RESET_ALL}") # message is an optional field containing a join/leave reason
 
     async def p_disconnect(self, packet: packets.Packet):
-        print(f"{Fore.MAGENTA}{packet.nickname} left the server{(': ' + packet.message) if packet.message else ''}{Style.RESET_ALL}")
+        self.show(f"{Fore.MAGENTA}{packet.nickname} left the server{(': ' + packet.message) if packet.message else ''}{Style.RESET_ALL}")
+
+    async def p_roster(self, packet: packets.Packet):
+        if not self.roster.apply(packet):
+            logger.debug("Missed roster updates after version {}, resyncing", self.roster.version)
+            await self.send(packets.serverbound.sync_roster(version=self.roster.version))
+            return
+        if packet.base == 0:
+            self.show(f"{Fore.MAGENTA}{len(self.roster)} online{Style.RESET_ALL}")
+            return
+
+        added, removed = unpack(packet.added), unpack(packet.removed)
+        if len(added) + len(removed) > ROSTER_DETAIL:
+            self.show(f"{Fore.MAGENTA}{len(added)} joined, {len(removed)} left ({len(self.roster)} online){Style.RESET_ALL}")
+            return
+        for nick in added:
+            self.show(f"{Fore.MAGENTA}{nick} joined the server{Style.RESET_ALL}")
+        for nick in removed:
+            self.show(f"{Fore.MAGENTA}{nick} left the server{Style.RESET_ALL}")
+
+    async def p_reconnect(self, packet: packets.Packet):
+        self.reconnect_delay = packet.delay_ms / 1000
+        self.show(f"{Fore.MAGENTA}{packet.message}, reconnecting in {self.reconnect_delay:.0f}s{Style.RESET_ALL}")
 
     async def p_direct_message(self, packet: packets.Packet):
-        print(f"{Back.LIGHTBLUE_EX}{Fore.BLACK} DM {Style.RESET_ALL} {Style.BRIGHT}{Fore.YELLOW}{packet.source}{Style.RESET_ALL}{Style.DIM} --> You: {Style.RESET_ALL}{packet.content}{Style.RESET_ALL}")
+        self.show(f"{Back.LIGHTBLUE_EX}{Fore.BLACK} DM {Style.RESET_ALL} {Style.BRIGHT}{Fore.YELLOW}{packet.source}{Style.RESET_ALL}{Style.DIM} --> You: {Style.RESET_ALL}{packet.content}{Style.RESET_ALL}")
 
     async def p_emote(self, packet: packets.Packet):
-        print(f"*{Fore.CYAN}{packet.nickname} {Style.RESET_ALL}{packet.content}{Style.RESET_ALL}")
+        self.show(f"{channel_prefix(packet.channel)}*{Fore.CYAN}{packet.nickname} {Style.RESET_ALL}{packet.content}{Style.RESET_ALL}")
+
+    async def p_history(self, packet: packets.Packet):
+        match packet.kind:
+            case 1: # emote
+                self.show(f"{Style.DIM}*{packet.nickname} {packet.content}{Style.RESET_ALL}")
+            case 2: # direct message
+                self.show(f"{Style.DIM} DM  {packet.nickname} --> {packet.target}: {packet.content}{Style.RESET_ALL}")
+            case _:
+                self.show(f"{Style.DIM}{packet.nickname}: {packet.content}{Style.RESET_ALL}")
+
+    async def p_batch(self, packet: packets.Packet):
+        """Unpack a batch and handle each event as if it had arrived on its own"""
+        for spec, fields in schema.split_batch(packet.events, schema.inbound("clientbound")):
+            await self.handle_packet(getattr(packets.clientbound, spec.name)(**fields))
+
+    async def p_session(self, packet: packets.Packet):
+        save_session(self.url, {"username": self.username, "token": packet.token, "expires": packet.expires})
 
     async def p_response(self, packet: packets.Packet):
+        if self.pending_resume: # the first response after resume is for it
+            self.pending_resume = False
+            if packet.value > 0:
+                save_session(self.url, None)
+                logger.error("Could not resume session ({}), log in again next time", packet.content)
+                return
         if packet.value > 0:
-            logger.error(f"Server returned faliure {packet.value}: {packet.content}")
+            logger.error("Server returned faliure {}: {}", packet.value, packet.content)
         else:
-            logger.debug(f"Server returned a success: {packet.content}")
+            logger.debug("Server returned a success: {}", packet.content)
+            if self.pending_command: # show the output of server-side commands like /who
+                self.show(packet.content)
+        self.pending_command = False
 
     async def handle_command(self, command: str) -> bool:
         cmd = command.lstrip('/').split(' ')
@@ -89,24 +218,30 @@ class Client(ConnectionHandler):
             cmd_class = commands.command_index[keyword]
         else: # defer to server
             cmd_pkt = packets.serverbound.command(keyword=keyword, args=' '.join(cmd))
+            self.pending_command = True
             await self.send(cmd_pkt)
             logger.debug("Sent command: {}", keyword)
             return False
 
         try:
-            args = cmd_utils.validate_args(cmd, cmd_class.validation)
-        except:
-            print("Usage: ", cmd_utils.make_command_string(cmd_class.keyword, cmd_class.validation))
+            args = cmd_class.parse_args(cmd)
+        except cmd_utils.CommandArgumentError:
+            print("Usage: ", cmd_class.usage)
             return False
 
         await cmd_class.invoke(self, keyword, **args)
         return True
 
-async def send_messages(client: Client):
-    # Continuously read user input and send messages.
-    while client.is_connected:
+async def read_input(lines: asyncio.Queue):
+    # Runs for the whole session: cancelling ainput would lose the line it was reading, e.g. across a reconnect
+    while True:
         # Green prompt for user input.
-        msg = await aioconsole.ainput(f"{Fore.GREEN}>> {Style.RESET_ALL}")
+        lines.put_nowait(await aioconsole.ainput(f"{Fore.GREEN}>> {Style.RESET_ALL}"))
+
+async def send_messages(client: Client, lines: asyncio.Queue):
+    # Continuously send what the user types.
+    while client.is_connected:
+        msg = await lines.get()
 
         # Process local commands (e.g. /set debugmode or /dm)
         if msg.startswith("/"):
@@ -114,47 +249,91 @@ async def send_messages(client: Client):
             continue
 
         if len(msg) > 0:
-            msg_pkt = packets.serverbound.send_message(content=msg)
+            msg_pkt = packets.serverbound.send_message(channel=client.channel, content=msg)
             await client.send(msg_pkt)
             logger.debug("Sent message: {}", msg)
 
 async def receive_messages(client: Client):
-    async for encoded_packet in client.conn:
-        try:
-            packet = packets.decode(encoded_packet)
-        except Exception as e:
-            logger.warning(f"Error while reading packet from server: {e}")
-        else:
-            await client.handle_packet(packet)
-
-        if not client.is_connected: break
+    try:
+        async for encoded_packet in client.conn:
+            try:
+                packet = packets.decode(encoded_packet)
+            except Exception as e:
+                logger.warning("Error while reading packet from server: {}", e)
+            else:
+                if packet.type_name in PRIORITY_PACKETS:
+                    await client.handle_packet(packet)
+                else:
+                    client.queue_event(packet)
+
+            if not client.is_connected: break
+    except websockets.ConnectionClosed: # e.g. 1012 when the server restarts, after which main() reconnects
+        if client.reconnect_delay is None:
+            logger.info("Connection closed by server.")
+    finally:
+        client.queue_event(None) # stop display_events
+
+async def display_events(client: Client):
+    # Handlers only format lines for the renderer, so this keeps up with whatever the receive loop queues
+    while (packet := await client.next_event()) is not None:
+        await client.handle_packet(packet)
 
 
 async def main():
-    # Configure loguru logging.
-    logger.remove()
+    # Configure logging.
     if DEBUG_ENABLED:
-        logger.add(sys.stdout, level="DEBUG", colorize=True)
+        logs.setup("DEBUG")
         logger.debug("Debug mode enabled.")
     else:
-        logger.add(sys.stdout, level="INFO", colorize=True)
+        logs.setup("INFO")
 
-    has_account = await asyncio.to_thread(input, ("Do you have an account? (y/n): ").lower())
-    username = await asyncio.to_thread(input, "Enter your username: ")
-    password = await asyncio.to_thread(input, "Enter password: ")
     url = f"ws://{IP_ADDR}:{IP_PORT}"
-    async with websockets.connect(url) as websocket:
-        client = Client(websocket, username)
-
-        if has_account.startswith('n'):
-            await client.register(username, password)
-
-        await client.login(username, password)
-
-        # Send the username as the first message.
-        await client.connect(username)
-        # Run both send and receive loops concurrently.
-        await asyncio.gather(send_messages(client), receive_messages(client))
+    session = load_sessions().get(url)
+    password = None
+    if session and session["expires"] > time.time():
+        username = session["username"]
+    else:
+        session = None
+        has_account = await asyncio.to_thread(input, ("Do you have an account? (y/n): ").lower())
+        username = await asyncio.to_thread(input, "Enter your username: ")
+        password = await asyncio.to_thread(input, "Enter password: ")
+
+    lines = asyncio.Queue()
+    reader = asyncio.create_task(read_input(lines))
+    while True:
+        async with websockets.connect(url, **TRANSPORT_OPTIONS) as websocket:
+            client = Client(websocket, username)
+            client.url = url
+
+            if session:
+                await client.resume(username, session["token"])
+            else:
+                if has_account.startswith('n'):
+                    await client.register(username, password)
+
+                await client.login(username, password)
+
+            # Send the username as the first message.
+            await client.connect(username)
+            # Run the send, receive and display loops concurrently.
+            client.renderer.start()
+            sender = asyncio.create_task(send_messages(client, lines))
+            try:
+                await asyncio.gather(receive_messages(client), display_events(client))
+            finally:
+                sender.cancel() # stop waiting for input to send on a closed connection
+                await asyncio.gather(sender, return_exceptions=True)
+                await client.renderer.stop()
+
+        if client.reconnect_delay is None:
+            break
+        # The server is restarting. Come back when it said to, resuming the session it gave us.
+        await asyncio.sleep(client.reconnect_delay)
+        session = load_sessions().get(url)
+        if session is None and password is None:
+            logger.error("No session to resume, start the client again to log in")
+            break
+    reader.cancel()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -170,5 +349,7 @@ if __name__ == "__main__":
     except ConnectionRefusedError:
         logger.critical("Connection refused by server. Is the server running?")
     except Exception as e: #^ IMPORTANT: HENRY DONT YOU FUCKING DARE REMOVE THIS
-        logger.critical(f"Something went wrong and I have no fucking clue what it was. Good luck debugging this one.")
+        logger.critical("Something went wrong and I have no fucking clue what it was. Good luck debugging this one.")
         raise e
+    finally:
+        logs.shutdown()
@@ -3,7 +3,7 @@ import sys
 from colorama import Style, Fore, Back
 from SCPC.util import packets
 
-from common import cmd_utils
+from common import cmd_utils, logs
 
 command_index = {}
 command_aliases = {}
@@ -37,10 +37,8 @@ class debugmode(Command):
         else:
             DEBUG_ENABLED = action
 
-        # Reconfigure loguru logger.
-        logger.remove()
-        new_level = "DEBUG" if DEBUG_ENABLED else "INFO"
-        logger.add(sys.stdout, level=new_level, colorize=True)
+        # Reconfigure logging.
+        logs.setup("DEBUG" if DEBUG_ENABLED else "INFO")
         print(f"Debug mode set to {DEBUG_ENABLED}")
         return (0, "")
 
@@ -127,7 +125,7 @@ class help(Command):
 
             if command in command_index:
                 cmd_class = command_index[command]
-                print(cmd_utils.make_command_string(cmd_class.keyword, cmd_class.validation)) # Print human-readable command string
+                print(cmd_class.usage) # Print human-readable command string
                 try:
                     print(cmd_class.description)
                 except AttributeError: # command has no description
@@ -137,8 +135,8 @@ class help(Command):
             else:
                 print(f"Command {command} not found")
         else:
-            for key, cmd_class in command_index.items():
-                print(cmd_utils.make_command_string(key, cmd_class.validation))
+            for cmd_class in command_index.values():
+                print(cmd_class.usage)
 
 class emote(Command):
     keyword = "emote"
@@ -154,5 +152,77 @@ class emote(Command):
 
     @classmethod
     async def invoke(cls, client, keyword: str, action: str):
-        msg_pkt = packets.serverbound.emote(content=action)
+        msg_pkt = packets.serverbound.emote(channel=client.channel, content=action)
         await client.send(msg_pkt)
+
+class history(Command):
+    keyword = "history"
+    aliases = ["backlog"]
+    validation = [
+        {
+            "name": "count",
+            "type": "int",
+            "required": False,
+            "default": 20,
+            "min_value": 1,
+            "max_value": 255
+        },
+        {
+            "name": "before",
+            "type": "int",
+            "required": False,
+            "default": 0,
+            "min_value": 0
+        }
+    ]
+    description = "Show recent messages, optionally from before a message number"
+
+    @classmethod
+    async def invoke(cls, client, keyword: str, count: int, before: int):
+        history_pkt = packets.serverbound.fetch_history(before=before, count=count)
+        await client.send(history_pkt)
+
+class join(Command):
+    keyword = "join"
+    aliases = ["j"]
+    validation = [
+        {
+            "name": "channel",
+            "type": "string",
+            "required": False,
+            "default": ""
+        }
+    ]
+    description = "Join a channel and send messages there, or go back to the lobby"
+
+    @classmethod
+    async def invoke(cls, client, keyword: str, channel: str):
+        if channel:
+            await client.send(packets.serverbound.join(channel=channel))
+        client.channel = channel
+        print(f"Now talking in {channel or 'the lobby'}")
+
+class part(Command):
+    keyword = "part"
+    aliases = ["leave"]
+    validation = [
+        {
+            "name": "channel",
+            "type": "string",
+            "required": False,
+            "default": ""
+        }
+    ]
+    description = "Leave a channel (default: the current one)"
+
+    @classmethod
+    async def invoke(cls, client, keyword: str, channel: str):
+        channel = channel or client.channel
+        if not channel:
+            print("You can't leave the lobby")
+            return
+
+        await client.send(packets.serverbound.part(channel=channel))
+        if channel.casefold() == client.channel.casefold():
+            client.channel = ""
+            print("Now talking in the lobby")
@@ -0,0 +1,309 @@
+"""Headless client for bots, integrations and load tests.
+
+    async with headless.connect(url, "helper", username="helper", password="...") as bot:
+        await bot.join("#help")
+        async for event in bot.events("recieve_message", "direct_message"):
+            if event.content == "!ping":
+                await bot.send_message("pong", event.channel)
+
+Events are the decoded clientbound packets (batches arrive already unpacked). Nothing is printed or
+rendered and there are no per-instance threads, so many bots can share one process and event loop.
+
+Run it directly to use the credentials in the `client { headless ... }` block of
+etc/cfg/config.kdl instead of prompts. Incoming events are printed as plain lines and lines read from
+stdin are sent as messages:
+    PYTHONPATH=src python src/client/headless.py [--instances N]
+"""
+import argparse
+import asyncio
+import sys
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+import kdl
+import websockets
+from loguru import logger
+from SCPC.util import packets
+from common.conn import ConnectionHandler
+from common import logs, paths, schema, transport
+from common import roster
+from common.roster import Roster
+from common.schema import FEATURE_BATCH, FEATURE_PRESENCE
+from common.gen_utils import config_section
+
+packets.init(paths.PACKETS_PATH)
+
+class ServerError(Exception):
+    """The server answered a request with a non-zero response code"""
+    def __init__(self, value: int, content: str):
+        super().__init__(f"{value}: {content}")
+        self.value = value
+        self.content = content
+
+class HeadlessClient(ConnectionHandler):
+    """Scriptable client. Requests wait for their response and raise ServerError on failure; everything
+    else the server sends is queued for events(). If nobody reads events, only the newest max_events are kept."""
+    __slots__ = ("token", "roster", "reconnect_delay", "pending", "queue", "dropped", "_wakeup", "_task", "_resync")
+    inbound = ("clientbound", "twoway")
+
+    def __init__(self, conn: websockets.ClientConnection, nick: str = "", max_events: int = 1000):
+        super().__init__(conn, nick)
+        self.token = None # session token from the last login
+        self.roster = Roster() # who is online, if connected with FEATURE_PRESENCE
+        self.reconnect_delay = None # seconds, if the server asked us to come back after it restarts
+        self.pending = deque() # futures of requests waiting for their response, in send order
+        self.queue = deque(maxlen=max_events)
+        self.dropped = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._resync = None # roster sync request in flight
+
+    def start(self):
+        self._task = asyncio.create_task(self._receive())
+
+    async def close(self, message: str = ""):
+        if self.is_connected:
+            self.is_connected = False
+            try:
+                await self.send(packets.serverbound.disconnect(message=message))
+            except websockets.ConnectionClosed:
+                pass
+        await self.conn.close()
+        if self._task:
+            await self._task
+
+    async def _receive(self):
+        try:
+            async for frame in self.conn:
+                try:
+                    packet = packets.decode(frame)
+                except Exception as e:
+                    logger.warning("Error while reading packet from server: {}", e)
+                else:
+                    await self.handle_packet(packet)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.is_connected = False
+            self._wakeup.set()
+            for future in self.pending:
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection closed"))
+
+    async def request(self, packet: packets.Packet) -> str:
+        """Send a packet that gets a response and return the response content"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        await self.send(packet)
+        value, content = await future
+        if value:
+            raise ServerError(value, content)
+        return content
+
+    async def events(self, *types: str):
+        """Iterate over received packets, optionally only those of the given type names, until the connection closes"""
+        while True:
+            while self.queue:
+                packet = self.queue.popleft()
+                if not types or packet.type_name in types:
+                    yield packet
+            if not self.is_connected:
+                return
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    def _queue_event(self, packet: packets.Packet):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(packet)
+        self._wakeup.set()
+
+    # Requests
+
+    async def register(self, username: str, password: str) -> str:
+        return await self.request(packets.serverbound.register(username=username, password=password))
+
+    async def login(self, username: str, password: str) -> str:
+        return await self.request(packets.serverbound.login(username=username, password=password))
+
+    async def resume(self, token: str) -> str:
+        self.token = token
+        return await self.request(packets.serverbound.resume(token=token))
+
+    async def connect(self, nickname: str, features: int = FEATURE_BATCH) -> str:
+        content = await self.request(packets.serverbound.connect(nickname=nickname, features=features))
+        self.nick = nickname
+        self.fully_connected = True
+        return content
+
+    async def send_message(self, content: str, channel: str = "") -> str:
+        return await self.request(packets.serverbound.send_message(channel=channel, content=content))
+
+    async def emote(self, content: str, channel: str = "") -> str:
+        return await self.request(packets.serverbound.emote(channel=channel, content=content))
+
+    async def direct_message(self, target: str, content: str) -> str:
+        return await self.request(packets.serverbound.direct_message(target=target, content=content))
+
+    async def command(self, keyword: str, args: str = "") -> str:
+        return await self.request(packets.serverbound.command(keyword=keyword, args=args))
+
+    async def join(self, channel: str) -> str:
+        return await self.request(packets.serverbound.join(channel=channel))
+
+    async def part(self, channel: str) -> str:
+        return await self.request(packets.serverbound.part(channel=channel))
+
+    # Packet handlers
+
+    async def p_keep_alive(self, packet: packets.Packet):
+        return (0, str(packet.timestamp))
+
+    async def p_response(self, packet: packets.Packet):
+        if self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_result((packet.value, packet.content))
+
+    async def p_session(self, packet: packets.Packet):
+        self.token = packet.token
+
+    async def p_batch(self, packet: packets.Packet):
+        for spec, fields in schema.split_batch(packet.events, schema.inbound("clientbound")):
+            self._queue_event(getattr(packets.clientbound, spec.name)(**fields))
+
+    async def p_roster(self, packet: packets.Packet):
+        if self.roster.apply(packet):
+            self._queue_event(packet)
+        elif self._resync is None or self._resync.done():
+            # Missed a delta. Not awaited here, as the response arrives on this same task.
+            self._resync = asyncio.create_task(self._sync_roster())
+
+    async def _sync_roster(self):
+        try:
+            await self.request(packets.serverbound.sync_roster(version=self.roster.version))
+        except (ServerError, ConnectionError, websockets.ConnectionClosed) as e:
+            # The next delta finds the gap again and retries
+            logger.warning("Roster resync failed: {}", e)
+
+    async def p_reconnect(self, packet: packets.Packet):
+        self.reconnect_delay = packet.delay_ms / 1000
+        self._queue_event(packet)
+
+    async def p_recieve_message(self, packet: packets.Packet):
+        self._queue_event(packet)
+
+    p_emote = p_connect = p_disconnect = p_direct_message = p_history = p_recieve_message
+
+@asynccontextmanager
+async def connect(url: str, nickname: str, username: str | None = None, password: str | None = None,
+                  token: str | None = None, register: bool = False, features: int = FEATURE_BATCH, **options):
+    """Open a HeadlessClient: authenticate (resume token, falling back to optionally registering and logging in)
+    and connect as nickname. Extra keyword arguments are passed to websockets.connect."""
+    conn = await websockets.connect(url, **options)
+    client = HeadlessClient(conn, nickname)
+    client.start()
+    try:
+        if token:
+            try:
+                await client.resume(token)
+            except ServerError: # expired or revoked
+                if not username:
+                    raise
+                token = None
+        if not token and username:
+            if register:
+                await client.register(username, password)
+            await client.login(username, password)
+        await client.connect(nickname, features)
+        yield client
+    finally:
+        await client.close()
+
+def describe(packet: packets.Packet) -> str:
+    """One plain line for an event"""
+    channel = f"[{packet.channel}] " if getattr(packet, "channel", "") else ""
+    match packet.type_name:
+        case "recieve_message": return f"{channel}{packet.nickname}: {packet.content}"
+        case "emote": return f"{channel}*{packet.nickname} {packet.content}"
+        case "direct_message": return f"DM {packet.source}: {packet.content}"
+        case "connect": return f"{packet.nickname} joined the server"
+        case "disconnect": return f"{packet.nickname} left the server"
+        case "history": return f"(history) {packet.nickname}: {packet.content}"
+        case "roster": return f"roster v{packet.version}: +{len(roster.unpack(packet.added))} -{len(roster.unpack(packet.removed))}"
+        case "reconnect": return f"{packet.message}, reconnecting in {packet.delay_ms / 1000:.1f}s"
+    return packet.type_name
+
+async def run(url: str, settings: dict, instances: int, options: dict):
+    """Run instances clients until interrupted. Lines from stdin are sent by the first one.
+    When the server restarts, each client waits the delay it was given and resumes its session."""
+    lines = asyncio.Queue()
+    active = [None] * instances # current HeadlessClient of each instance
+    loop = asyncio.get_running_loop()
+    def read_stdin(): # a daemon thread, so a pending readline doesn't hold up exit
+        for line in sys.stdin:
+            loop.call_soon_threadsafe(lines.put_nowait, line.rstrip('\n'))
+    threading.Thread(target=read_stdin, name="stdin", daemon=True).start()
+
+    async def one(i: int):
+        suffix = str(i) if instances > 1 else ""
+        nickname = settings.get("nickname", "bot") + suffix
+        username = settings["username"] + suffix if settings.get("username") else None
+        channel = settings.get("channel", "")
+        token = None
+        while True:
+            async with connect(url, nickname, username, settings.get("password"), token=token,
+                               register=bool(settings.get("register", False)) and token is None, **options) as client:
+                active[i] = client
+                if channel:
+                    await client.join(channel)
+                async for event in client.events():
+                    print(f"<{nickname}> {describe(event)}" if suffix else describe(event), flush=True)
+            if client.reconnect_delay is None:
+                return
+            await asyncio.sleep(client.reconnect_delay)
+            token = client.token
+
+    async def send_lines(channel: str):
+        while True:
+            line = await lines.get()
+            client = active[0]
+            if client is None or not client.is_connected:
+                logger.error("Message not sent: not connected")
+                continue
+            try:
+                await client.send_message(line, channel)
+            except (ServerError, ConnectionError, websockets.ConnectionClosed) as e:
+                logger.error("Message not sent: {}", e)
+
+    sender = asyncio.create_task(send_lines(settings.get("channel", "")))
+    try:
+        await asyncio.gather(*(one(i) for i in range(instances)))
+    finally:
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless chat client")
+    parser.add_argument("-c", "--config", default=paths.CONFIG_PATH)
+    parser.add_argument("-n", "--instances", type=int, default=1, help="Clients to run in this process (numbered nicknames)")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as infile:
+        cfg = kdl.parse(infile.read())
+    ip = cfg["client"]["server"]["ip"].args[0]
+    port = cfg["client"]["server"]["port"].args[0]
+    options = transport.options(config_section(cfg, "client", "transport"), server=False)
+
+    logs.setup("INFO", stream=sys.stderr)
+    try:
+        asyncio.run(run(f"ws://{ip}:{port}", config_section(cfg, "client", "headless"), args.instances, options))
+    except KeyboardInterrupt:
+        pass
+    except (ServerError, ConnectionRefusedError) as e:
+        logger.critical("Could not connect: {}", e)
+    finally:
+        logs.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import asyncio
+import sys
+from collections import deque
+from colorama import Style
+
+class Renderer:
+    """Terminal output pipeline. show() only queues a line. A render task writes everything queued
+    since the last frame in one write, at most fps times a second, on a worker thread, so a slow
+    terminal never blocks the event loop (input prompt, keep-alives).
+
+    At most `scrollback` lines wait to be written. If the terminal falls further behind than that,
+    the oldest lines are skipped and a note says how many."""
+    def __init__(self, fps: float = 30, scrollback: int = 1000, stream=None):
+        self.interval = 1 / fps
+        self.stream = stream or sys.stdout
+        self.lines = deque(maxlen=scrollback)
+        self.skipped = 0
+        self._task = None
+
+    def show(self, text: str):
+        if len(self.lines) == self.lines.maxlen:
+            self.skipped += 1
+        self.lines.append(text)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Write what is left and stop"""
+        if self._task:
+            self._task.cancel()
+        await asyncio.to_thread(self._write, self._take())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.lines:
+                await asyncio.to_thread(self._write, self._take())
+
+    def _take(self) -> str:
+        lines = list(self.lines)
+        self.lines.clear()
+        if self.skipped:
+            lines.insert(0, f"{Style.DIM}... {self.skipped} lines skipped ...{Style.RESET_ALL}")
+            self.skipped = 0
+        return ''.join(i + '\n' for i in lines)
+
+    def _write(self, text: str):
+        if text:
+            self.stream.write(text)
+            self.stream.flush()
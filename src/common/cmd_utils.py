@@ -1,69 +1,94 @@
+from typing import Callable
+
 class CommandRegistryMeta(type):
-    """Metaclass which will run register() on all classes which inherit from this one"""
+    """Metaclass which will run register() on all classes which inherit from this one.
+    The command's validation list is compiled once here into cls.parse_args and cls.usage."""
     def __init__(cls, name, bases, class_dict):
         super().__init__(name, bases, class_dict)
         if bases: # Is this class (e.g. msg) inheriting from the class using this meta (Command)?
+            cls.parse_args, cls.usage = compile_validation(cls.keyword, cls.validation)
             cls.register_command(cls) # Run register_command() on the parent class
 
 class CommandValidationKeyError(Exception):
     pass
 
-def validate_args(args: list, validation: list) -> dict:
-    """Takes a list of arguments and validation keys and returns the formatted args
-    Raise an exception if args does not comply with validation input"""
-    result = {}
-    required = True
-    repeat = False
+class CommandArgumentError(ValueError):
+    """The arguments given to a command don't match its validation keys"""
+    pass
 
+BOOL_WORDS = {"on": True, "yes": True, "true": True, "y": True, "off": False, "no": False, "false": False, "n": False}
+
+def _compile_key(key: dict) -> Callable[[str], object]:
+    """Turn one validation key into a function converting a single argument"""
+    match key['type']:
+        case "int": convert = int
+        case "float": convert = float
+        case "bool": convert = lambda arg: BOOL_WORDS[arg.lower()]
+        case "option":
+            options = frozenset(key['options'])
+            def convert(arg):
+                arg = arg.lower()
+                if arg not in options:
+                    raise CommandArgumentError(f"{key['name']} must be one of {', '.join(key['options'])}")
+                return arg
+        case _: convert = str # string, string..
+
+    low, high = key.get('min_value'), key.get('max_value')
+    if low is None and high is None:
+        return convert
+
+    def bounded(arg):
+        arg = convert(arg)
+        if (low is not None and arg < low) or (high is not None and arg > high):
+            raise CommandArgumentError(f"{key['name']} out of range")
+        return arg
+    return bounded
+
+def compile_validation(keyword: str, validation: list) -> tuple[Callable[[list], dict], str]:
+    """Check a command's validation keys once and return (parser, usage string).
+    The parser takes a list of arguments and returns the formatted args,
+    raising CommandArgumentError if they don't comply with the validation keys."""
+    steps = [] # (name, converter, is repeating, default)
+    required_count = 0
+    required = True
     for i, key in enumerate(validation):
-        # Has there already been a repeating argument?
-        if repeat:
+        if steps and steps[-1][2]:
             raise CommandValidationKeyError("No arguments allowed after repeating arg")
-
-        # Is the current value required while the last wasn't?
-        # If so, the validation key is flawed, because a required argument cannot be after an optional arg
+        # A required argument cannot be after an optional arg
         if key['required'] and not required:
             raise CommandValidationKeyError("Required argument cannot be after optional argument")
-
-        try:
-            arg = args[i]
-        except IndexError:
-            #^ refactor
-            if key['required']:
-                raise IndexError
+        required = key['required']
+        if required:
+            required_count = i + 1
+        steps.append((key['name'], _compile_key(key), key['type'] == "string..", key.get('default')))
+
+    def parse(args: list) -> dict:
+        if len(args) < required_count:
+            raise CommandArgumentError("Missing arguments")
+
+        result = {}
+        for i, (name, convert, repeating, default) in enumerate(steps):
+            if i >= len(args):
+                result[name] = default
+            elif repeating: # String that uses the remainder of the command (e.g. "/msg user hello how are you?")
+                result[name] = ' '.join(args[i:])
             else:
-                arg = key['default']
-                result[key['name']] = arg
-                continue
-
-        match key['type']:
-            case "string..": # String that uses the remainder of the command (e.g. "/msg user hello how are you?") <- all arguments after 'user' are considered part of the same argument
-                arg = ' '.join(args[i:])
-                repeat = True
-            case "string": pass # already string
-            case "int": arg = int(arg)
-            case "bool":
-                arg = arg.lower()
-                if arg in ["on", "yes", "true", "y"]:
-                    arg = True
-                elif arg in ["off", "no", "false", "n"]:
-                    arg = False
-                else:
-                    raise AssertionError
-            case "float": arg = float(arg)
-            case "option":
-                arg = arg.lower()
-                assert arg in key["options"]
-
-        if "max_value" in key:
-            assert arg <= key['max_value']
+                try:
+                    result[name] = convert(args[i])
+                except CommandArgumentError:
+                    raise
+                except (ValueError, KeyError) as e:
+                    raise CommandArgumentError(f"Invalid value for {name}") from e
+        return result
 
-        if "min_value" in key:
-            assert arg >= key['min_value']
+    return parse, make_command_string(keyword, validation)
 
-        result[key['name']] = arg
-
-    return result
+def validate_args(args: list, validation: list) -> dict:
+    """Takes a list of arguments and validation keys and returns the formatted args
+    Raise an exception if args does not comply with validation input.
+    Prefer the command's precompiled parse_args, which skips re-checking the validation keys."""
+    parse, _ = compile_validation("", validation)
+    return parse(args)
 
 def make_command_string(keyword: str, validation: list) -> str:
     """Turn command information into a human-readable string"""
@@ -85,3 +110,7 @@ def make_command_string(keyword: str, validation: list) -> str:
         command_str += f" {arg_str}"
 
     return command_str
+
+def split_args(args: str) -> list:
+    """Split a command's argument string the way the client joined it"""
+    return args.split(' ') if args else []
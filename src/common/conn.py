@@ -1,20 +1,76 @@
+from typing import Callable, NamedTuple
 import websockets
 from SCPC.util import packets
+from common import schema
+from common.ratelimit import RateLimiter
+
+class Handler(NamedTuple):
+    func: Callable
+    type_id: int
+    wants_response: bool # schema flag 'r'
+    fully_connected: bool # sender must have sent connect first
+    auth: bool # sender must be logged in
+
+def packet_handler(fully_connected: bool = False, auth: bool = False):
+    """Declare the requirements of a p_* packet handler, checked before it is called"""
+    def decorator(func):
+        func.fully_connected = fully_connected
+        func.auth = auth
+        return func
+    return decorator
 
 class ConnectionHandler:
+    """One end of a connection. Subclasses declare their own __slots__ too, as the server keeps one per
+    connected client and a __dict__ per instance adds up at tens of thousands of connections."""
+    __slots__ = ("conn", "addr", "nick", "fully_connected", "is_connected", "user", "rate_limiter")
+    inbound = ("serverbound", "clientbound", "twoway") # packet directions this side receives
+
+    def __init_subclass__(cls, **kwargs):
+        """Build the dispatch table once per class: {packet type id: Handler} for every p_* method.
+        Keyed by id rather than name, as some names exist in both directions (connect, emote, ...) with different
+        fields, and only the direction this side receives may reach the handler."""
+        super().__init_subclass__(**kwargs)
+        specs = schema.inbound(*cls.inbound)
+        cls.dispatch = {}
+        for attr in dir(cls):
+            if not attr.startswith("p_"):
+                continue
+            func = getattr(cls, attr)
+            spec = specs.get(attr[2:])
+            if spec is None: # no such packet in the directions we receive
+                continue
+            cls.dispatch[spec.type_id] = Handler(func, spec.type_id, 'r' in spec.flags,
+                                                 getattr(func, "fully_connected", False), getattr(func, "auth", False))
+
     def __init__(self, conn: websockets.ClientConnection, nick: str = ""):
         self.conn = conn
         self.addr = conn.remote_address[0] if conn.remote_address else ""
         self.nick = nick
         self.fully_connected = False
         self.is_connected = True
+        self.user = None # username once logged in
+        self.rate_limiter: RateLimiter | None = None
 
     async def handle_packet(self, packet: packets.Packet):
-        packet_func = getattr(self, "p_" + packet.type_name) # Find the function in self that's named 'p_packettype'
-        response = await packet_func(packet) # Call the function
-        if 'r' in packet.flags and response: # Does this packet type say a response is wanted?
-            resp_packet = packets.twoway.response(value=response[0], content=response[1])
-            await self.send(resp_packet) # send response
+        if self.rate_limiter and not self.rate_limiter.allow(packet.type_name):
+            return await self.respond(packet, (6, "Rate limited"))
+
+        handler = self.dispatch.get(packet.type_id)
+        if handler is None:
+            return await self.respond(packet, (9, "Unknown packet type"))
+        if handler.fully_connected and not self.fully_connected:
+            return await self.respond(packet, (127, "Client connection not complete"))
+        if handler.auth and self.user is None:
+            return await self.respond(packet, (10, "Not logged in"))
+
+        response = await handler.func(self, packet) # Call the function
+        if handler.wants_response and response: # Does this packet type say a response is wanted?
+            await self.send(packets.twoway.response(value=response[0], content=response[1])) # send response
+
+    async def respond(self, packet: packets.Packet, response: tuple[int, str]):
+        """Send response if packet's type asks for one"""
+        if 'r' in packet.flags:
+            await self.send(packets.twoway.response(value=response[0], content=response[1]))
 
     async def send(self, packet: packets.Packet):
         await self.conn.send(packet.encode())
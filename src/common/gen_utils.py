@@ -1,4 +1,4 @@
-import logging
+from loguru import logger
 
 class Response:
     """A class to manage general-purpose responses"""
@@ -8,11 +8,23 @@ class Response:
 
         if log:
             if success:
-                logging.info(content)
+                logger.info("{}", content)
             else:
-                logging.warning(content)
-        else:
-            logging.debug(content)
+                logger.warning("{}", content)
 
     def __bool__(self):
         return self.success
+
+def config_node(cfg, *path: str):
+    """Walk a parsed KDL document down path and return the node there, or None if it doesn't exist"""
+    node = cfg
+    for name in path:
+        node = node.get(name)
+        if node is None:
+            return None
+    return node
+
+def config_section(cfg, *path: str) -> dict:
+    """Return the properties of the node at path in a parsed KDL document ({} if the node doesn't exist)"""
+    node = config_node(cfg, *path)
+    return dict(node.props) if node is not None else {}
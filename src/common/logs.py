@@ -0,0 +1,106 @@
+"""One logging setup for client and server.
+
+Everything goes through loguru. Messages below the configured level are discarded before any formatting
+(so log with "{}" placeholders, not f-strings), stdlib logging (websockets, sqlite helpers) is routed into
+loguru, and enabled messages are handed to a background thread for writing so a slow terminal or disk
+never blocks the event loop."""
+import itertools
+import logging
+import queue
+import sys
+import threading
+from loguru import logger
+
+_levels = {name: logger.level(name).no for name in ("TRACE", "DEBUG", "INFO", "SUCCESS", "WARNING", "ERROR", "CRITICAL")}
+_min_level = _levels["INFO"]
+
+class BackgroundSink:
+    """loguru sink that queues formatted messages for a writer thread. Drops messages rather than blocking when the queue is full."""
+    def __init__(self, stream, max_queue: int = 10000):
+        self.stream = stream
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, message: str):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+            batch = [message]
+            while True: # write everything that has piled up in one go
+                try:
+                    message = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if message is None:
+                    self._write(batch)
+                    return
+                batch.append(message)
+            self._write(batch)
+
+    def _write(self, batch: list):
+        try:
+            self.stream.write(''.join(batch))
+            self.stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def stop(self):
+        """Write what is queued and stop the thread"""
+        self.queue.put(None)
+        self._thread.join(5)
+
+class InterceptHandler(logging.Handler):
+    """Forward stdlib logging records to loguru"""
+    def emit(self, record: logging.LogRecord):
+        try:
+            level = logger.level(record.levelname).name
+        except ValueError:
+            level = record.levelno
+        logger.opt(depth=6, exception=record.exc_info).log(level, record.getMessage())
+
+_sink = None
+
+def setup(level: str = "INFO", stream=None, colorize: bool | None = None):
+    """(Re)configure logging. Safe to call again, e.g. to switch debug mode on.
+    colorize defaults to whether the stream is a terminal, as loguru decides for stream sinks."""
+    global _min_level, _sink
+    logger.remove()
+    if _sink is None:
+        _sink = BackgroundSink(stream or sys.stdout)
+    if colorize is None:
+        try:
+            colorize = _sink.stream.isatty()
+        except (AttributeError, ValueError):
+            colorize = False
+    logger.add(_sink.write, level=level, colorize=colorize, format="<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>")
+    _min_level = _levels[level]
+
+    stdlib_level = logging.DEBUG if _min_level <= _levels["DEBUG"] else logging.INFO
+    logging.basicConfig(handlers=[InterceptHandler()], level=stdlib_level, force=True)
+
+def shutdown():
+    logger.remove()
+    if _sink:
+        _sink.stop()
+
+def dropped() -> int:
+    """Messages dropped because the writer thread fell behind"""
+    return _sink.dropped if _sink else 0
+
+def enabled(level: str) -> bool:
+    """Would a message at level be logged? Check before building anything expensive to log."""
+    return _levels[level] >= _min_level
+
+def sampler(every: int):
+    """Returns a function that is True once per every calls, for logging only a sample of high-volume events"""
+    counter = itertools.count()
+    return lambda: next(counter) % every == 0
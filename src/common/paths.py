@@ -0,0 +1,12 @@
+"""Where config and data files live. Relative paths are resolved against the repository root (or
+$PYCHAT_ROOT if set) rather than the working directory, so client and server can be started from anywhere."""
+import os
+
+ROOT = os.path.abspath(os.environ.get("PYCHAT_ROOT") or os.path.join(os.path.dirname(__file__), "..", ".."))
+
+def resolve(path: str) -> str:
+    """Absolute path for a path from the config (absolute paths are returned unchanged)"""
+    return os.path.join(ROOT, path)
+
+CONFIG_PATH = resolve("etc/cfg/config.kdl")
+PACKETS_PATH = resolve("etc/cfg/packets.kdl")
@@ -0,0 +1,73 @@
+import time
+
+class TokenBucket:
+    """Classic token bucket: holds up to burst tokens and refills at rate tokens per second"""
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, cost: float = 1) -> bool:
+        self.refill(time.monotonic())
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+class RateLimiter:
+    """Limits one connection: an overall bucket, a bucket per packet type and a bucket shared by every connection.
+    A packet is only allowed if every bucket that applies to it has enough tokens, and only then are they spent.
+    Per-type buckets are created the first time that type is sent, as most connections only ever send a few types."""
+    __slots__ = ("connection", "limits", "per_type", "shared", "exempt")
+
+    def __init__(self, connection: tuple[float, float] | None = None, per_type: dict[str, tuple[float, float]] | None = None,
+                 shared: TokenBucket | None = None, exempt: tuple[str, ...] = ("disconnect",)):
+        self.connection = TokenBucket(*connection) if connection else None
+        self.limits = per_type or {} # shared with every other limiter, never modified
+        self.per_type = {}
+        self.shared = shared
+        self.exempt = exempt
+
+    def allow(self, type_name: str, cost: float = 1) -> bool:
+        if type_name in self.exempt:
+            return True
+
+        bucket = self.per_type.get(type_name)
+        if bucket is None and type_name in self.limits:
+            bucket = self.per_type[type_name] = TokenBucket(*self.limits[type_name])
+        buckets = [i for i in (bucket, self.connection, self.shared) if i is not None]
+        now = time.monotonic()
+        for bucket in buckets:
+            bucket.refill(now)
+            if bucket.tokens < cost:
+                return False
+
+        for bucket in buckets:
+            bucket.tokens -= cost
+        return True
+
+def limits_from_config(node) -> tuple:
+    """Read a ratelimit KDL node into (global limit, connection limit, {packet type: limit}), where each limit is (rate, burst) or None:
+        ratelimit {
+            global rate=500 burst=1000
+            connection rate=10 burst=20
+            packet "send_message" rate=2 burst=5
+        }"""
+    shared, connection, per_type = None, None, {}
+    if node is None:
+        return shared, connection, per_type
+
+    for child in node.nodes:
+        limit = (float(child.props["rate"]), float(child.props["burst"]))
+        match child.name:
+            case "global": shared = limit
+            case "connection": connection = limit
+            case "packet": per_type[child.args[0]] = limit
+    return shared, connection, per_type
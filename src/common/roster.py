@@ -0,0 +1,36 @@
+from common.schema import FIELD_SEP
+
+# Nicknames in roster packets are separated by FIELD_SEP, which can't appear in a nickname
+def pack(nicks) -> str:
+    return FIELD_SEP.join(nicks)
+
+def unpack(field: str) -> list[str]:
+    return field.split(FIELD_SEP) if field else []
+
+class Roster:
+    """Client-side copy of the server's presence roster"""
+    def __init__(self):
+        self.version = 0
+        self.online = {} # casefolded nick: nick
+
+    def __len__(self):
+        return len(self.online)
+
+    def __contains__(self, nick: str):
+        return nick.casefold() in self.online
+
+    def names(self) -> list[str]:
+        return sorted(self.online.values(), key=str.casefold)
+
+    def apply(self, packet) -> bool:
+        """Apply a roster packet. Returns False if it is a delta from a version we don't have (resync needed)."""
+        if packet.base == 0:
+            self.online = {}
+        elif packet.base != self.version:
+            return False
+        for nick in unpack(packet.removed):
+            self.online.pop(nick.casefold(), None)
+        for nick in unpack(packet.added):
+            self.online[nick.casefold()] = nick
+        self.version = packet.version
+        return True
@@ -0,0 +1,56 @@
+from functools import lru_cache
+from typing import NamedTuple
+import kdl
+from common import paths
+
+PACKETS_PATH = paths.PACKETS_PATH
+
+class PacketSpec(NamedTuple):
+    name: str
+    type_id: int
+    flags: str
+    fields: tuple[str, ...] # field names in wire order
+
+@lru_cache(maxsize=None)
+def load(path: str = PACKETS_PATH) -> dict[str, dict[str, PacketSpec]]:
+    """Parse a packet definition file into {"serverbound": {"send_message": PacketSpec, ...}, ...}"""
+    with open(path, 'r') as infile:
+        doc = kdl.parse(infile.read())
+
+    directions = {}
+    for section in doc.nodes:
+        if not section.nodes: # e.g. version
+            continue
+        specs = directions[section.name] = {}
+        for node in section.nodes:
+            flags = node.args[1] if len(node.args) > 1 else ""
+            specs[node.name] = PacketSpec(node.name, int(node.args[0]), flags, tuple(node.props))
+    return directions
+
+def inbound(*directions: str, path: str = PACKETS_PATH) -> dict[str, PacketSpec]:
+    """Merge the packet specs of several directions, e.g. inbound("serverbound", "twoway")"""
+    schema = load(path)
+    merged = {}
+    for direction in directions:
+        merged.update(schema.get(direction, {}))
+    return merged
+
+# Bits of connect.features, the optional behaviour a client asks the server for
+FEATURE_BATCH = 0x01 # accept batch packets
+FEATURE_PRESENCE = 0x02 # roster snapshot and deltas instead of connect/disconnect packets
+
+# A batch packet carries several string-only events as records separated by RECORD_SEP, each being
+# the packet name then its fields in wire order, separated by FIELD_SEP. Servers must keep these
+# (non-printable) characters out of anything that can be batched.
+RECORD_SEP = "\x1e"
+FIELD_SEP = "\x1f"
+
+def batch_record(packet, spec: PacketSpec) -> str:
+    return FIELD_SEP.join((spec.name, *(getattr(packet, i) for i in spec.fields)))
+
+def split_batch(events: str, specs: dict[str, PacketSpec]):
+    """Yield (PacketSpec, {field: value}) for each record of a batch packet"""
+    for record in events.split(RECORD_SEP):
+        name, *values = record.split(FIELD_SEP)
+        spec = specs[name]
+        yield spec, dict(zip(spec.fields, values))
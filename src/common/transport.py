@@ -0,0 +1,41 @@
+"""Websocket transport settings for client and server, read from a `transport` node in config.kdl.
+
+websockets.serve/connect are given explicit options instead of library defaults:
+    compression  - "deflate" (permessage-deflate) or "none"
+    window_bits  - deflate window, 9 to 15. Smaller windows cost less memory per connection but compress worse.
+    mem_level    - zlib memLevel, 1 to 9. Same trade-off for the compressor's internal state.
+    max_size     - largest inbound message in bytes (0 = the caller's default)
+    max_queue    - inbound messages buffered per connection before reading pauses
+    write_limit  - outbound buffer high-water mark in bytes, after which send() waits for the socket to drain
+"""
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory, ServerPerMessageDeflateFactory
+
+COMPRESSION = ("deflate", "none")
+
+def deflate_memory(window_bits: int, mem_level: int) -> int:
+    """Approximate bytes zlib allocates for one compressor and one decompressor with these settings"""
+    return (1 << (window_bits + 2)) + (1 << (mem_level + 9)) + (1 << window_bits) + 7 * 1024
+
+def options(props: dict, server: bool, max_size: int = 2 ** 20) -> dict:
+    """Keyword arguments for websockets.serve (server=True) or websockets.connect built from a transport node's props"""
+    compression = props.get("compression", "deflate")
+    if compression not in COMPRESSION:
+        raise ValueError(f"Unknown transport compression: {compression}")
+
+    kwargs = {
+        "compression": None,
+        "max_size": int(props.get("max_size", 0)) or max_size,
+        "max_queue": int(props.get("max_queue", 16)),
+        "write_limit": int(props.get("write_limit", 32768)),
+    }
+    if compression == "deflate":
+        window_bits = int(props.get("window_bits", 15))
+        compress_settings = {"memLevel": int(props.get("mem_level", 8))}
+        if server:
+            # Also limit the window clients compress with, so our decompressors stay small too
+            factory = ServerPerMessageDeflateFactory(server_max_window_bits=window_bits, client_max_window_bits=window_bits,
+                                                     compress_settings=compress_settings)
+        else:
+            factory = ClientPerMessageDeflateFactory(client_max_window_bits=window_bits, compress_settings=compress_settings)
+        kwargs["extensions"] = [factory]
+    return kwargs
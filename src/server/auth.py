@@ -1,14 +1,32 @@
 import sqlite3
-import hashlib
 import uuid
-import logging
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
 from common.gen_utils import Response
+from hashing import PasswordHasher
+from db import Store
+import metrics
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+DB_PATH = "data/server.db"
 
-db = sqlite3.connect("data/server.db")
-cur = db.cursor()
-cur.execute("CREATE TABLE IF NOT EXISTS users (uuid VARCHAR, username VARCHAR, pswdhash VARCHAR)")
+class UserStore(Store):
+    """User database with one SQLite connection per thread"""
+    def __init__(self, path: str = DB_PATH):
+        super().__init__(path)
+
+    def migrate(self):
+        db = self.db
+        db.execute("CREATE TABLE IF NOT EXISTS users (uuid VARCHAR, username VARCHAR, pswdhash VARCHAR)")
+        try:
+            db.execute("CREATE UNIQUE INDEX IF NOT EXISTS users_username ON users (username)")
+        except sqlite3.IntegrityError:
+            logger.warning("Duplicate usernames in {}, username index is not unique", self.path)
+            db.execute("CREATE INDEX IF NOT EXISTS users_username_dup ON users (username)")
+        db.commit()
+
+store = UserStore()
 
 class User:
     def __init__(self, username: str):
@@ -16,45 +34,93 @@ class User:
         Create a new User class with no authentication methods."""
         self.uuid = uuid.uuid1()
         self.name = username
-        Response(True, f"Initialized User instance for username: {username}")
 
     @classmethod
     def check_username_available(cls, username: str) -> bool:
-        logging.debug("Checking if username '%s' exists in the database.", username)
-        cur.execute("SELECT * FROM users WHERE username = ?", (username,))
-        if cur.fetchone():
+        logger.debug("Checking if username '{}' exists in the database.", username)
+        if store.db.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone():
             return Response(False, f"Username {username} exists")
         else:
             return Response(True, f"Username {username} does not exist.")
 
     @classmethod
-    def register(cls, username: str, password: str):
+    def find_uuid(cls, username: str) -> str | None:
+        """UUID of a registered user, or None"""
+        row = store.db.execute("SELECT uuid FROM users WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else None
+
+    @classmethod
+    def register(cls, username: str, password: str, hasher: PasswordHasher):
         """Register a user using username and password"""
-        logging.debug("Attempting to register user with username: %s", username)
+        logger.debug("Attempting to register user with username: {}", username)
         if not cls.check_username_available(username):
             return Response(False, "Username taken")
 
         user = cls(username)
-        user.pswdhash = hashlib.sha256(password.encode()).hexdigest()
+        user.pswdhash = hasher.hash(password)
 
-        cur.execute("INSERT INTO users VALUES (?, ?, ?)", (str(user.uuid), user.name, user.pswdhash))
-        db.commit()
+        db = store.db
+        try:
+            db.execute("INSERT INTO users VALUES (?, ?, ?)", (str(user.uuid), user.name, user.pswdhash))
+            db.commit()
+        except sqlite3.IntegrityError: # registered by another worker since the check
+            db.rollback()
+            return Response(False, "Username taken")
 
-        logging.info(f"User {username} registered successfully")
+        logger.info("User {} registered successfully", username)
         return Response(True, "Registered")
 
     @classmethod
-    def login(cls, username: str, password: str):
+    def login(cls, username: str, password: str, hasher: PasswordHasher):
         """Login a user using username and password"""
-        cur.execute("SELECT * FROM users WHERE username = ? AND pswdhash = ?", (username, hashlib.sha256(password.encode()).hexdigest()))
-        resp = cur.fetchone()
-        if resp:
+        resp = store.db.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+        if resp is None:
+            hasher.dummy_verify(password)
+        elif hasher.verify(password, resp[2]):
             user = cls(resp[1])
             user.uuid = resp[0]
             user.pswdhash = resp[2]
 
-            logging.info(f"User {username} logged in")
+            if hasher.needs_rehash(user.pswdhash): # stored with an old format or cost
+                user.pswdhash = hasher.hash(password)
+                db = store.db
+                db.execute("UPDATE users SET pswdhash = ? WHERE uuid = ?", (user.pswdhash, user.uuid))
+                db.commit()
+                logger.info("Rehashed password for user {}", username)
+
+            logger.info("User {} logged in", username)
             return Response(True, "Logged in")
-        else:
-            logging.info(f"User {username} failed to log in")
-            return Response(False, "Incorrect username or password")
+
+        logger.info("User {} failed to log in", username)
+        return Response(False, "Incorrect username or password")
+
+def default_workers() -> int:
+    """Leave at least half the cores free for the event loop when logins flood in"""
+    return max(1, (os.cpu_count() or 2) // 2)
+
+class AuthService:
+    """Runs User database and hashing work on a fixed-size thread pool so it never blocks the event loop.
+    The pool size is also the cap on how many passwords are hashed at once."""
+    def __init__(self, workers: int | None = None, hasher: PasswordHasher | None = None):
+        self.executor = ThreadPoolExecutor(max_workers=workers or default_workers(), thread_name_prefix="auth")
+        self.hasher = hasher or PasswordHasher()
+
+    async def _run(self, func, *args):
+        with metrics.timer(metrics.db_seconds, func.__name__):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def register(self, username: str, password: str) -> Response:
+        return await self._run(User.register, username, password, self.hasher)
+
+    async def login(self, username: str, password: str) -> Response:
+        return await self._run(User.login, username, password, self.hasher)
+
+    async def uuid_of(self, username: str) -> str | None:
+        return await self._run(User.find_uuid, username)
+
+    async def tune(self, target_ms: float) -> float:
+        """Benchmark the hasher on a worker thread and scale its cost to target_ms per hash"""
+        return await self._run(self.hasher.tune, target_ms)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,60 @@
+MAX_CHANNEL_NAME = 32
+
+class ChannelIndex:
+    """Channel name -> member set, plus each client's own set of channel keys so parting everything is cheap.
+    Names are matched casefolded. Empty channels are removed."""
+    def __init__(self):
+        self._members = {} # {"casefolded name": {<Client>, ...}}
+        self._names = {} # {"casefolded name": "Display Name"}
+
+    @staticmethod
+    def key(name: str) -> str:
+        return name.casefold()
+
+    @staticmethod
+    def valid_name(name: str) -> bool:
+        return 0 < len(name) <= MAX_CHANNEL_NAME and name.isprintable() and not any(i.isspace() for i in name)
+
+    def __len__(self):
+        return len(self._members)
+
+    def join(self, name: str, client) -> bool:
+        """Add client to name, creating the channel if needed. Returns False if client was already a member."""
+        key = self.key(name)
+        members = self._members.get(key)
+        if members is None:
+            members = self._members[key] = set()
+            self._names[key] = name
+        if client in members:
+            return False
+        members.add(client)
+        client.channels.add(key)
+        return True
+
+    def part(self, name: str, client) -> bool:
+        """Remove client from name. Returns False if client wasn't a member."""
+        key = self.key(name)
+        members = self._members.get(key)
+        if members is None or client not in members:
+            return False
+        members.discard(client)
+        client.channels.discard(key)
+        if not members:
+            del self._members[key]
+            del self._names[key]
+        return True
+
+    def part_all(self, client):
+        for key in list(client.channels):
+            self.part(key, client)
+
+    def members(self, name: str) -> set:
+        """The live member set of name. Don't mutate it; it's shared rather than copied so routing stays cheap."""
+        return self._members.get(self.key(name), set())
+
+    def name(self, name: str) -> str:
+        return self._names.get(self.key(name), name)
+
+    def list(self) -> list[tuple[str, int]]:
+        """[(display name, member count), ...]"""
+        return [(self._names[key], len(members)) for key, members in self._members.items()]
@@ -0,0 +1,196 @@
+"""Multi-process mode: N workers accept on the same port (SO_REUSEPORT) and talk to a hub in the
+supervisor process over a Unix socket. The hub owns the cluster-wide nickname table, so nickname
+claims stay unique across workers and DMs can be routed to whichever worker holds the target.
+
+Bus messages are marshal-encoded tuples behind a 4 byte length prefix:
+    worker -> hub: ("hello", worker_id) ("claim", req, nick) ("release", nick)
+                   ("broadcast", data, key, channel, record) ("dm", req, target, data)
+    hub -> worker: ("claimed", req, ok) ("broadcast", data, key, channel, record) ("deliver", target, data) ("dm_result", req, found)
+                   ("presence", online, offline)
+
+A worker gets a "presence" with the nicknames held by the other workers when it says hello, and every
+worker gets one with the nicknames a worker held when it dies, so their rosters don't keep its users online.
+
+The hub never waits on a worker. One that falls more than max_buffer bytes behind on reading is disconnected
+instead of having every relayed broadcast buffered for it; it exits on losing the bus and is restarted.
+"""
+import asyncio
+import itertools
+import marshal
+import multiprocessing
+import os
+import signal
+import struct
+import tempfile
+from typing import Callable
+from loguru import logger
+
+_header = struct.Struct("!I")
+
+async def _read_msg(reader: asyncio.StreamReader) -> tuple:
+    size, = _header.unpack(await reader.readexactly(_header.size))
+    return marshal.loads(await reader.readexactly(size))
+
+def _write_msg(writer: asyncio.StreamWriter, msg: tuple):
+    data = marshal.dumps(msg)
+    writer.write(_header.pack(len(data)) + data)
+
+class BusHub:
+    """Runs in the supervisor. Relays broadcasts between workers and keeps the nickname -> worker table."""
+    def __init__(self, path: str, max_buffer: int = 16 * 2 ** 20):
+        self.path = path
+        self.max_buffer = max_buffer
+        self.workers = {} # {worker_id: StreamWriter}
+        self.nicks = {} # {"casefolded nick": worker_id}
+        self.names = {} # {"casefolded nick": nick as claimed}
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self._handle, self.path)
+        os.chmod(self.path, 0o600)
+
+    def _send(self, worker_id: int, msg: tuple):
+        writer = self.workers.get(worker_id)
+        if writer is None:
+            return
+        if writer.transport.get_write_buffer_size() > self.max_buffer:
+            logger.error("Worker {} is more than {} bytes behind on the bus, disconnecting it", worker_id, self.max_buffer)
+            del self.workers[worker_id]
+            writer.transport.abort() # its _handle sees the connection drop and frees its nicknames
+            return
+        _write_msg(writer, msg)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker_id = None
+        try:
+            _, worker_id = await _read_msg(reader)
+            self.workers[worker_id] = writer
+            self._send(worker_id, ("presence", [self.names[key] for key, owner in self.nicks.items() if owner != worker_id], []))
+            while True:
+                msg = await _read_msg(reader)
+                match msg[0]:
+                    case "claim":
+                        _, req, nick = msg
+                        holder = self.nicks.setdefault(nick.casefold(), worker_id)
+                        if holder == worker_id:
+                            self.names[nick.casefold()] = nick
+                        self._send(worker_id, ("claimed", req, holder == worker_id))
+                    case "release":
+                        if self.nicks.get(msg[1].casefold()) == worker_id:
+                            del self.nicks[msg[1].casefold()]
+                            del self.names[msg[1].casefold()]
+                    case "broadcast":
+                        for other_id in list(self.workers):
+                            if other_id != worker_id:
+                                self._send(other_id, msg)
+                    case "dm":
+                        _, req, target, data = msg
+                        owner = self.nicks.get(target.casefold())
+                        found = owner in self.workers
+                        if found:
+                            self._send(owner, ("deliver", target, data))
+                        self._send(worker_id, ("dm_result", req, found))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if worker_id is not None:
+                logger.warning("Worker {} left the bus", worker_id)
+                if self.workers.get(worker_id) is writer: # not already replaced by its restarted successor
+                    del self.workers[worker_id]
+                freed = [key for key, owner in self.nicks.items() if owner == worker_id]
+                offline = [self.names.pop(key) for key in freed]
+                for key in freed:
+                    del self.nicks[key]
+                if offline:
+                    for other_id in list(self.workers):
+                        self._send(other_id, ("presence", [], offline))
+            writer.close()
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+class BusClient:
+    """A worker's connection to the hub"""
+    def __init__(self, worker_id: int, on_broadcast: Callable[[bytes, str, str], None], on_deliver: Callable[[str, bytes], None],
+                 on_presence: Callable[[list[str], list[str]], None]):
+        self.worker_id = worker_id
+        self.on_broadcast = on_broadcast
+        self.on_deliver = on_deliver
+        self.on_presence = on_presence
+        self.pending = {} # {request id: Future}
+        self._ids = itertools.count()
+        self.reader = self.writer = self._task = None
+
+    async def connect(self, path: str):
+        self.reader, self.writer = await asyncio.open_unix_connection(path)
+        _write_msg(self.writer, ("hello", self.worker_id))
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while True:
+                msg = await _read_msg(self.reader)
+                match msg[0]:
+                    case "broadcast": self.on_broadcast(*msg[1:])
+                    case "deliver": self.on_deliver(msg[1], msg[2])
+                    case "presence": self.on_presence(msg[1], msg[2])
+                    case "claimed" | "dm_result":
+                        future = self.pending.pop(msg[1], None)
+                        if future and not future.done():
+                            future.set_result(msg[2])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.critical("Lost connection to the cluster bus")
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    async def _request(self, *msg) -> bool:
+        req = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[req] = future
+        _write_msg(self.writer, (msg[0], req, *msg[1:]))
+        return await future
+
+    async def claim(self, nick: str) -> bool:
+        """Claim nick across the whole cluster"""
+        return await self._request("claim", nick)
+
+    def release(self, nick: str):
+        _write_msg(self.writer, ("release", nick))
+
+    def publish(self, data: bytes, key: str | None, channel: str = "", record: str | None = None):
+        """Send an encoded broadcast frame (and its batch record, if any) for channel to every other worker"""
+        _write_msg(self.writer, ("broadcast", data, key, channel, record))
+
+    async def direct(self, target: str, data: bytes) -> bool:
+        """Deliver an encoded frame to target on whichever worker holds them. Returns False if nobody does."""
+        return await self._request("dm", target, data)
+
+def run_cluster(workers: int, worker_main: Callable[[int, str], None], max_buffer: int = 16 * 2 ** 20):
+    """Start the hub and workers processes running worker_main(worker_id, bus_path), restarting any that die.
+    max_buffer is how far (in bytes) a worker may fall behind on the bus before it is disconnected."""
+    bus_path = os.path.join(tempfile.mkdtemp(prefix="pychat-"), "bus.sock")
+    ctx = multiprocessing.get_context("spawn") # don't fork SQLite handles or the event loop
+
+    async def supervise():
+        hub = BusHub(bus_path, max_buffer)
+        await hub.start()
+        procs = {}
+        try:
+            while True:
+                for i in range(workers):
+                    if i not in procs or not procs[i].is_alive():
+                        if i in procs:
+                            logger.error("Worker {} exited with code {}, restarting", i, procs[i].exitcode)
+                        procs[i] = ctx.Process(target=worker_main, args=(i, bus_path), name=f"pychat-worker-{i}")
+                        procs[i].start()
+                await asyncio.sleep(1)
+        finally:
+            for proc in procs.values():
+                proc.terminate()
+            for proc in procs.values():
+                proc.join(5)
+            await hub.close()
+
+    logger.info("Starting {} workers", workers)
+    asyncio.run(supervise())
@@ -4,14 +4,70 @@ from colorama import Style, Fore, Back
 from SCPC.util import packets
 
 from common import cmd_utils
+import metrics as metrics_mod
 
 command_index = {}
 command_aliases = {}
 
+server = None # the running server module, set by server.py so commands can reach its state
+
 class Command(metaclass=cmd_utils.CommandRegistryMeta):
+    permission = None # permission the user needs, e.g. "admin"
+    cost = 1 # rate limit tokens the command uses up
+
     @classmethod
     def register_command(cls, subclass):
         """Registers subclasses in the command_index"""
         command_index[subclass.keyword] = subclass # {"message": <message object>}
         for i in subclass.aliases:
             command_aliases[i] = subclass.keyword
+
+def resolve(keyword: str):
+    """Return the command class for a keyword or alias, or None"""
+    return command_index.get(command_aliases.get(keyword, keyword))
+
+class who(Command):
+    keyword = "who"
+    aliases = ["names"]
+    validation = [
+        {
+            "name": "channel",
+            "type": "string",
+            "required": False,
+            "default": ""
+        }
+    ]
+    description = "List the members of a channel, or everyone connected"
+
+    @classmethod
+    async def invoke(cls, client, keyword: str, channel: str) -> tuple[int, str]:
+        return (0, ', '.join(member.nick for member in server.audience(channel)))
+
+class channels(Command):
+    keyword = "list"
+    aliases = ["channels"]
+    validation = []
+    description = "List channels and their member counts"
+
+    @classmethod
+    async def invoke(cls, client, keyword: str) -> tuple[int, str]:
+        return (0, ', '.join(f"{name} ({count})" for name, count in server.channels.list()) or "No channels")
+
+class metrics(Command):
+    keyword = "metrics"
+    aliases = ["stats"]
+    permission = "admin"
+    validation = [
+        {
+            "name": "prefix",
+            "type": "string",
+            "required": False,
+            "default": "pychat_"
+        }
+    ]
+    description = "Show server metrics whose names start with prefix"
+
+    @classmethod
+    async def invoke(cls, client, keyword: str, prefix: str) -> tuple[int, str]:
+        lines = [i for i in metrics_mod.registry.render().splitlines() if i.startswith(prefix)]
+        return (0, '\n'.join(lines) or "No matching metrics")
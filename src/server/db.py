@@ -0,0 +1,100 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from loguru import logger
+import metrics
+from common import paths
+
+class Store:
+    """Base for SQLite-backed stores. Each thread gets its own connection, opened in WAL mode.
+    Nothing is opened until first use (or open()), when subclasses create their tables in migrate()."""
+    def __init__(self, path: str):
+        self.path = paths.resolve(path)
+        self._local = threading.local()
+        self._migrated = False
+        self._migrate_lock = threading.Lock()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL") # readers don't block the writer
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            with self._migrate_lock:
+                if not self._migrated:
+                    self._migrated = True
+                    self.migrate()
+        return db
+
+    def open(self):
+        """Connect and create tables now instead of on first use"""
+        self.db
+
+    def migrate(self):
+        pass
+
+class BatchWriter:
+    """Group-commits rows to a store off the event loop.
+
+    add() only appends to a buffer. A background task hands the buffer to write_batch on a single
+    writer thread once it holds max_batch rows or max_delay seconds have passed, so many rows share
+    one transaction and rows are written in the order they were added."""
+    def __init__(self, write_batch: Callable[[list], None], max_batch: int = 256, max_delay: float = 0.05, name: str = "batch"):
+        self.write_batch = write_batch
+        self.name = name
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = []
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dbwriter")
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closed = False
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def add(self, row):
+        self.pending.append(row)
+        if len(self.pending) == 1 or len(self.pending) >= self.max_batch:
+            self._wakeup.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while not (self._closed and not self.pending):
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            # Give the batch a chance to fill up before committing
+            deadline = time.monotonic() + self.max_delay
+            while len(self.pending) < self.max_batch and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                self._wakeup.clear()
+
+            batch, self.pending = self.pending, []
+            if batch:
+                try:
+                    with metrics.timer(metrics.db_seconds, self.name):
+                        await loop.run_in_executor(self.executor, self.write_batch, batch)
+                except Exception as e:
+                    logger.error("Failed to write batch of {} rows: {}", len(batch), e)
+
+    async def close(self):
+        """Write anything still pending and stop"""
+        self._closed = True
+        self._wakeup.set()
+        if self._task:
+            await self._task
+        self.executor.shutdown(wait=True)
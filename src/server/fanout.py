@@ -0,0 +1,216 @@
+import asyncio
+from collections import deque
+from typing import Callable, Iterable
+import websockets
+from loguru import logger
+
+POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+dropped_total = 0 # frames dropped by every outbox, for metrics
+
+class Outbox:
+    """Bounded outbound queue for one connection, drained by its own writer task.
+
+    Frames are already-encoded bytes so a broadcast can share one encoding between every subscriber.
+    When the queue is full, push() applies the overflow policy:
+        drop_oldest - discard the oldest queued frame
+        coalesce    - discard the oldest queued frame with the same key (e.g. packet type), else the oldest
+        disconnect  - drop everything and call on_overflow so the owner can kick the client
+    Frames queued with put() (replies and backfill, which already waited for room) are never discarded by the
+    first two policies; if nothing else is left to discard, the new frame is dropped instead.
+
+    With batching enabled, push_event() collects events for up to batch_window seconds (or batch_max events)
+    and queues them as a single batch frame. Any other frame flushes the pending batch first to keep ordering.
+
+    There is one per connection, so it is slotted and only holds a future while its writer is waiting and an
+    event while put() is waiting for room, instead of two asyncio.Events for its whole life.
+    """
+    __slots__ = ("conn", "maxsize", "policy", "on_overflow", "frames", "dropped", "closed", "_wakeup", "_space", "_task",
+                 "encode_batch", "batch", "batch_max", "batch_window", "_flush_handle")
+
+    def __init__(self, conn: websockets.ServerConnection, maxsize: int = 256, policy: str = "drop_oldest",
+                 on_overflow: Callable[[], None] | None = None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown outbound policy: {policy}")
+
+        self.conn = conn
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_overflow = on_overflow
+        self.frames = deque() # (key, data, kept), kept frames came from put() and are never evicted
+        self.dropped = 0
+        self.closed = False
+        self._wakeup = None # future the writer waits on while there is nothing to send
+        self._space = None # event put() waits on while the queue is full
+        self._task = None
+
+        self.encode_batch = None # Callable[[list[str]], bytes] once batching is enabled
+        self.batch = [] # [(data, record)] waiting to be flushed
+        self.batch_max = 0
+        self.batch_window = 0
+        self._flush_handle = None
+
+    def __len__(self):
+        return len(self.frames) + len(self.batch)
+
+    def enable_batching(self, encode_batch: Callable[[list[str]], bytes], max_events: int = 32, window: float = 0.005):
+        self.encode_batch = encode_batch
+        self.batch_max = max_events
+        self.batch_window = window
+
+    def push_event(self, data: bytes, record: str, key: str | None = None) -> bool:
+        """Queue a batchable event: its encoded frame and its batch record"""
+        if self.encode_batch is None:
+            return self.push(data, key)
+        if self.closed:
+            return False
+
+        self.batch.append((data, record))
+        if len(self.batch) >= self.batch_max:
+            self.flush_batch()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self.flush_batch)
+        return True
+
+    def flush_batch(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self.batch:
+            return
+
+        batch, self.batch = self.batch, []
+        if len(batch) == 1: # not worth wrapping
+            self._queue(batch[0][0], None)
+        else:
+            self._queue(self.encode_batch([record for _, record in batch]), "batch")
+
+    def start(self):
+        self._task = asyncio.create_task(self._writer())
+
+    def push(self, data: bytes, key: str | None = None) -> bool:
+        """Queue a frame without waiting. Returns False if the frame was not queued."""
+        if self.closed:
+            return False
+        if self.batch:
+            self.flush_batch()
+        return self._queue(data, key)
+
+    def _queue(self, data: bytes, key: str | None) -> bool:
+        if len(self.frames) >= self.maxsize and not self._overflow(key):
+            return False
+
+        self.frames.append((key, data, False))
+        self._wake()
+        return True
+
+    async def put(self, data: bytes, key: str | None = None) -> bool:
+        """Queue a frame, waiting for room instead of applying the overflow policy"""
+        if self.batch:
+            self.flush_batch()
+        while len(self.frames) >= self.maxsize and not self.closed:
+            if self._space is None:
+                self._space = asyncio.Event()
+            self._space.clear()
+            await self._space.wait()
+
+        if self.closed:
+            return False
+
+        self.frames.append((key, data, True))
+        self._wake()
+        return True
+
+    def _overflow(self, key: str | None) -> bool:
+        global dropped_total
+        dropped_total += 1
+        self.dropped += 1
+        match self.policy:
+            case "drop_oldest" | "coalesce":
+                victim = self._victim(key if self.policy == "coalesce" else None)
+                if victim is None: # only kept frames are queued
+                    return False
+                del self.frames[victim]
+            case "disconnect":
+                self.abort()
+                if self.on_overflow:
+                    self.on_overflow()
+                return False
+        return True
+
+    def _victim(self, key: str | None) -> int | None:
+        """Index of the oldest evictable frame with key (or any key if None), else of the oldest evictable frame"""
+        oldest = None
+        for i, (queued_key, _, kept) in enumerate(self.frames):
+            if kept:
+                continue
+            if key is None or queued_key == key:
+                return i
+            if oldest is None:
+                oldest = i
+        return oldest
+
+    def _wake(self):
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    def _make_space(self):
+        if self._space is not None:
+            self._space.set()
+
+    async def _writer(self):
+        try:
+            while True:
+                while not self.frames:
+                    if self.closed:
+                        return
+                    self._wakeup = asyncio.get_running_loop().create_future()
+                    await self._wakeup
+                    self._wakeup = None
+
+                _, data, _ = self.frames.popleft()
+                self._make_space()
+                await self.conn.send(data)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.closed = True
+            self.frames.clear()
+            self._make_space()
+
+    def close(self):
+        """Stop accepting frames. Anything already queued is still written."""
+        if self.batch and not self.closed:
+            self.flush_batch()
+        self.closed = True
+        self._wake()
+        self._make_space()
+
+    def abort(self):
+        """Stop accepting frames and discard anything queued"""
+        self.batch.clear()
+        self.frames.clear()
+        self.close()
+
+    async def drain(self, timeout: float | None = None):
+        """Close the outbox and wait for the writer to flush what is queued"""
+        self.close()
+        if self._task:
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Outbox for {} did not drain in time ({} frames left)", self.conn.remote_address, len(self.frames))
+
+def fanout(data: bytes, outboxes: Iterable[Outbox], key: str | None = None, record: str | None = None) -> int:
+    """Hand one encoded frame to every outbox. If the frame has a batch record, outboxes that batch get that instead.
+    Returns the number of outboxes that accepted it."""
+    sent = 0
+    if record is None:
+        for outbox in outboxes:
+            if outbox.push(data, key):
+                sent += 1
+    else:
+        for outbox in outboxes:
+            if outbox.push_event(data, record, key):
+                sent += 1
+    return sent
@@ -0,0 +1,122 @@
+import base64
+import hashlib
+import hmac
+import os
+import time
+from loguru import logger
+
+# Never tune below these, however slow the machine is
+SCRYPT_MIN_LOG_N = 14
+PBKDF2_MIN_ITERATIONS = 200_000
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip('=')
+
+def _unb64(data: str) -> bytes:
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+class ScryptBackend:
+    name = "scrypt"
+
+    def __init__(self, log_n: int = SCRYPT_MIN_LOG_N, r: int = 8, p: int = 1):
+        self.params = {"ln": log_n, "r": r, "p": p}
+
+    @staticmethod
+    def derive(password: bytes, salt: bytes, params: dict) -> bytes:
+        n, r, p = 2 ** params["ln"], params["r"], params["p"]
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 2 ** 20, dklen=32)
+
+    @staticmethod
+    def cost(params: dict) -> int:
+        return 2 ** params["ln"] * params["r"] * params["p"]
+
+    @staticmethod
+    def scaled(params: dict, factor: float) -> dict:
+        """params with the work factor multiplied by roughly factor (rounded down to a power of two)"""
+        log_n = params["ln"]
+        while factor >= 2:
+            log_n += 1
+            factor /= 2
+        return {**params, "ln": log_n}
+
+class Pbkdf2Backend:
+    name = "pbkdf2-sha256"
+
+    def __init__(self, iterations: int = PBKDF2_MIN_ITERATIONS):
+        self.params = {"i": iterations}
+
+    @staticmethod
+    def derive(password: bytes, salt: bytes, params: dict) -> bytes:
+        return hashlib.pbkdf2_hmac("sha256", password, salt, params["i"])
+
+    @staticmethod
+    def cost(params: dict) -> int:
+        return params["i"]
+
+    @staticmethod
+    def scaled(params: dict, factor: float) -> dict:
+        return {**params, "i": int(params["i"] * factor)}
+
+backends = {i.name: i for i in (ScryptBackend, Pbkdf2Backend)}
+
+class PasswordHasher:
+    """Salted password hashing with a versioned, self-describing format:
+        $<backend>$<k=v,...>$<salt>$<hash>
+    Bare 64 character hex strings are treated as legacy unsalted sha256 hashes.
+    The backend's params are never changed in place, only replaced, as tune() can run while other threads hash."""
+    def __init__(self, backend: str = "scrypt"):
+        if backend not in backends:
+            raise ValueError(f"Unknown password hash backend: {backend}")
+        self.backend = backends[backend]()
+
+    def hash(self, password: str) -> str:
+        salt = os.urandom(16)
+        params = self.backend.params # the same params for the hash and the prefix describing it
+        digest = self.backend.derive(password.encode(), salt, params)
+        encoded_params = ','.join(f"{k}={v}" for k, v in params.items())
+        return f"${self.backend.name}${encoded_params}${_b64(salt)}${_b64(digest)}"
+
+    @staticmethod
+    def parse(encoded: str) -> tuple[str, dict, bytes, bytes]:
+        """Split an encoded hash into (backend name, params, salt, hash)"""
+        if not encoded.startswith('$'): # legacy sha256 hex
+            return ("sha256", {}, b"", bytes.fromhex(encoded))
+
+        _, name, params, salt, digest = encoded.split('$')
+        params = {k: int(v) for k, v in (i.split('=') for i in params.split(','))}
+        return (name, params, _unb64(salt), _unb64(digest))
+
+    def verify(self, password: str, encoded: str) -> bool:
+        name, params, salt, digest = self.parse(encoded)
+        if name == "sha256":
+            candidate = hashlib.sha256(password.encode()).digest()
+        else:
+            candidate = backends[name].derive(password.encode(), salt, params)
+        return hmac.compare_digest(candidate, digest)
+
+    def dummy_verify(self, password: str):
+        """Spend the same time as a real verify, so unknown usernames can't be told apart by timing"""
+        self.backend.derive(password.encode(), b"\0" * 16, self.backend.params)
+
+    def needs_rehash(self, encoded: str) -> bool:
+        """Is encoded using a different backend or a weaker cost than the current settings?"""
+        name, params, _, _ = self.parse(encoded)
+        if name != self.backend.name:
+            return True
+        return self.backend.cost(params) < self.backend.cost(self.backend.params)
+
+    def tune(self, target_ms: float) -> float:
+        """Raise the work factor until one hash takes about target_ms. Returns the measured time in ms."""
+        elapsed = self._measure(self.backend.params)
+        if 0 < elapsed < target_ms:
+            params = self.backend.scaled(self.backend.params, target_ms / elapsed)
+            elapsed = self._measure(params)
+            self.backend.params = params
+
+        logger.info("Password hashing tuned: {} {} takes {:.1f}ms (target {}ms)", self.backend.name, self.backend.params, elapsed, target_ms)
+        return elapsed
+
+    def _measure(self, params: dict) -> float:
+        start = time.perf_counter()
+        self.backend.derive(b"benchmark", b"\0" * 16, params)
+        return (time.perf_counter() - start) * 1000
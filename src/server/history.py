@@ -0,0 +1,65 @@
+import time
+from db import Store, BatchWriter
+
+KIND_MESSAGE = 0
+KIND_EMOTE = 1
+KIND_DIRECT = 2
+
+class HistoryStore(Store):
+    """Append-only log of messages, emotes and DMs.
+
+    Rows are keyed by an increasing sequence number, which doubles as the pagination cursor,
+    and indexed by timestamp. Appends go through a BatchWriter so they are group-committed.
+    DMs also record the usernames of both ends, as nicknames aren't tied to accounts: they are only
+    served back to the logged-in users who sent or received them."""
+    def __init__(self, path: str = "data/history.db", max_batch: int = 256, max_delay: float = 0.05):
+        super().__init__(path)
+        self.writer = BatchWriter(self._write_batch, max_batch, max_delay, "history_write")
+
+    def migrate(self):
+        db = self.db
+        db.execute("""CREATE TABLE IF NOT EXISTS history (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,
+            kind INTEGER NOT NULL,
+            source VARCHAR NOT NULL,
+            target VARCHAR NOT NULL DEFAULT '',
+            content VARCHAR NOT NULL,
+            source_user VARCHAR NOT NULL DEFAULT '',
+            target_user VARCHAR NOT NULL DEFAULT '')""")
+        columns = {row[1] for row in db.execute("PRAGMA table_info(history)")}
+        for column in ("source_user", "target_user"): # DMs logged before these existed stay unowned, so nobody gets them
+            if column not in columns:
+                db.execute(f"ALTER TABLE history ADD COLUMN {column} VARCHAR NOT NULL DEFAULT ''")
+        db.execute("CREATE INDEX IF NOT EXISTS history_ts ON history (ts)")
+        db.commit()
+
+    def start(self):
+        self.writer.start()
+
+    async def close(self):
+        await self.writer.close()
+
+    def append(self, kind: int, source: str, content: str, target: str = "", source_user: str = "", target_user: str = ""):
+        """Queue an entry to be written with the next batch. target is the recipient of a DM, or the channel of anything else.
+        source_user and target_user are the usernames behind a DM's nicknames ("" if not logged in or not known here)."""
+        self.writer.add((int(time.time()), kind, source, target, content, source_user or "", target_user or ""))
+
+    def _write_batch(self, rows: list):
+        db = self.db
+        db.executemany("INSERT INTO history (ts, kind, source, target, content, source_user, target_user) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        db.commit()
+
+    def fetch(self, user: str | None, before: int, count: int, channels: tuple[str, ...] = ()) -> list[tuple]:
+        """Return up to count entries with seq < before (0 = newest), oldest first.
+        Messages and emotes are only included from the lobby and the given channels (target holds the channel),
+        and DMs only if the logged-in user sent or received them (none without a login)."""
+        if before <= 0:
+            before = 2 ** 63 - 1
+        rows = self.db.execute(f"""SELECT seq, ts, kind, source, target, content FROM history
+            WHERE seq < ? AND CASE kind
+                WHEN ? THEN ? != '' AND (source_user = ? OR target_user = ?)
+                ELSE target IN ({','.join('?' * (len(channels) + 1))}) END
+            ORDER BY seq DESC LIMIT ?""", (before, KIND_DIRECT, user or "", user, user, "", *channels, count)).fetchall()
+        rows.reverse()
+        return rows
@@ -0,0 +1,86 @@
+"""Keep-alives, round trip times and reaping of dead or idle connections.
+
+Connections are spread over a timing wheel of `slots` buckets, one of which is visited every
+interval / slots seconds, so each connection is checked once per interval but 10k connections never
+wake up together. A connection lands in a random slot when it is added, which also jitters when its
+keep-alives go out relative to everyone else's."""
+import asyncio
+import random
+import time
+from typing import Callable
+from loguru import logger
+import metrics
+
+def timestamp_ms() -> int:
+    """Monotonic milliseconds, wrapped to fit keep_alive's uint32 timestamp"""
+    return int(time.monotonic() * 1000) & 0xFFFFFFFF
+
+def rtt_ms(echoed: int) -> int:
+    """Round trip time of a keep-alive whose timestamp came back as echoed"""
+    return (timestamp_ms() - echoed) & 0xFFFFFFFF
+
+class KeepAlive:
+    """Timing wheel of connections. Each visit to a connection either reaps it or sends it a keep-alive:
+        - no packet at all for misses * interval seconds: dead, reaped as "Timed out"
+        - fully connected with no activity but keep-alives for idle_limit seconds: reaped as "Idle" (0 = never)
+    Connections need last_seen and last_active (time.monotonic()) attributes, plus fully_connected."""
+    def __init__(self, send: Callable[[object, int], None], reap: Callable[[object, str], None],
+                 interval: float = 30, misses: int = 3, idle_limit: float = 0, slots: int = 64):
+        self.send = send # send(conn, timestamp)
+        self.reap = reap # reap(conn, reason)
+        self.interval = interval
+        self.misses = misses
+        self.idle_limit = idle_limit
+        self.wheel = [set() for _ in range(max(1, slots))]
+        self.slot_of = {} # conn: slot index
+        self.position = 0
+        self._task = None
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def add(self, conn):
+        slot = random.randrange(len(self.wheel))
+        self.wheel[slot].add(conn)
+        self.slot_of[conn] = slot
+
+    def remove(self, conn):
+        slot = self.slot_of.pop(conn, None)
+        if slot is not None:
+            self.wheel[slot].discard(conn)
+
+    def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def _run(self):
+        tick = self.interval / len(self.wheel)
+        next_tick = time.monotonic()
+        while True:
+            next_tick += tick
+            await asyncio.sleep(max(0, next_tick - time.monotonic()))
+            try:
+                self.visit(self.wheel[self.position])
+            except Exception as e:
+                logger.error("Keep-alive tick failed: {}", e)
+            self.position = (self.position + 1) % len(self.wheel)
+
+    def visit(self, slot: set):
+        now = time.monotonic()
+        stamp = timestamp_ms()
+        dead_after = self.misses * self.interval
+        for conn in list(slot):
+            if now - conn.last_seen > dead_after:
+                reason = "Timed out"
+            elif self.idle_limit and conn.fully_connected and now - conn.last_active > self.idle_limit:
+                reason = "Idle"
+            else:
+                self.send(conn, stamp)
+                continue
+            self.remove(conn)
+            metrics.reaped_total.inc(reason)
+            self.reap(conn, reason)
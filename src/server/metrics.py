@@ -0,0 +1,142 @@
+"""In-process server metrics, rendered in the Prometheus text format.
+
+Recording is a dict lookup and an add, cheap enough to leave on in production.
+Anything that can be computed from existing state (queue depths, connection counts) is a
+CallbackGauge evaluated only when metrics are scraped."""
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Callable
+from loguru import logger
+
+# Seconds. Fine-grained at the bottom because most packets are handled in well under a millisecond.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000)
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ','.join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+        return lines
+
+class Gauge(Counter):
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+class CallbackGauge:
+    """Gauge whose value is computed by func when scraped"""
+    def __init__(self, name: str, help: str, func: Callable[[], float]):
+        self.name, self.help, self.func = name, help, func
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.func()}"]
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.values = {} # {labels: [bucket counts..., +Inf count, sum]}
+
+    def observe(self, value: float, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in self.values.items():
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series):
+                total += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {total}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+registry = Registry()
+
+packets_total = registry.add(Counter("pychat_packets_total", "Packets received, by type", ("type",)))
+packet_seconds = registry.add(Histogram("pychat_packet_seconds", "Time spent handling a packet, by type", ("type",)))
+broadcast_seconds = registry.add(Histogram("pychat_broadcast_seconds", "Time spent encoding and queueing a broadcast"))
+broadcast_fanout = registry.add(Histogram("pychat_broadcast_fanout", "Local recipients per broadcast", buckets=SIZE_BUCKETS))
+db_seconds = registry.add(Histogram("pychat_db_seconds", "Database and password hashing calls, including time queued for a worker", ("op",)))
+keepalive_rtt_seconds = registry.add(Histogram("pychat_keepalive_rtt_seconds", "Round trip time of keep-alives"))
+reaped_total = registry.add(Counter("pychat_reaped_connections_total", "Connections dropped by the keep-alive scheduler, by reason", ("reason",)))
+startup_seconds = registry.add(Gauge("pychat_startup_phase_seconds", "Time taken by each startup phase", ("phase",)))
+moderation_total = registry.add(Counter("pychat_moderated_messages_total", "Messages blocked or masked by the moderation filter, by action", ("action",)))
+loop_lag_seconds = registry.add(Histogram("pychat_event_loop_lag_seconds", "How late the event loop wakes up from a sleep"))
+
+async def monitor_loop_lag(interval: float = 0.5):
+    """Sleep for interval and record how late we wake up: a busy or blocked event loop wakes up late"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag_seconds.observe(max(0.0, loop.time() - start - interval))
+
+async def serve(address: str, port: int):
+    """Serve registry.render() over plain HTTP at /metrics"""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)).strip(): # skip headers
+                pass
+            if request.split(b' ')[1:2] == [b"/metrics"]:
+                body, status = registry.render().encode(), "200 OK"
+            else:
+                body, status = b"Not found\n", "404 Not Found"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, address, port)
+    logger.info("Metrics available at http://{}:{}/metrics", address, port)
+    return server
+
+class timer:
+    """with timer(histogram, *labels): ... records the block's duration"""
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram, *labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
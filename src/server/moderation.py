@@ -0,0 +1,171 @@
+"""Message moderation: blocked words, regex rules and duplicate detection.
+
+Rules are loaded from a KDL file (see etc/cfg/moderation.kdl) and compiled once into one regex per action.
+Word lists are merged into a trie-shaped pattern, which keeps the regex small and its matching cheap with
+thousands of words: the scan is linear in the message. Regex rules are alternatives in the same regex, so
+each of them is still tried at every position, and a rule that refers to its own groups (backreferences,
+named groups) gets a regex of its own, as joining rules renumbers their groups. The file is watched and
+recompiled on a worker thread when it changes.
+
+Matching runs on the casefolded message without re.IGNORECASE, which is about twice as fast and lets sre use
+its literal prefix optimisations. Casefolding can change the length of the text ("ß" -> "ss"), so the spans
+of mask matches are mapped back to the original characters they came from before those are starred out."""
+import asyncio
+import os
+import re
+import time
+from collections import OrderedDict
+import kdl
+from loguru import logger
+import metrics
+
+ACTIONS = ("block", "mask")
+GLOBAL_FLAGS = re.compile(r"\(\?[aiLmsux]+\)") # e.g. (?i) at the start of a rule, which would apply to every rule joined with it
+GROUP_REFERENCE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(") # \1, (?P=name), (?(1)...): only valid with the rule's own numbering
+
+def trie_pattern(words) -> str:
+    """One regex alternation for words, sharing common prefixes: ["cat", "car"] -> "ca(?:r|t)" """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {} # end of a word
+
+    def build(node: dict) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        if "" in node:
+            return f"(?:{'|'.join(branches)})?"
+        return branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+    return build(trie)
+
+def mask(content: str, folded: str, matchers: tuple[re.Pattern, ...]) -> str:
+    """Star out the characters of content whose casefolded form (folded) any of matchers matches"""
+    origin = [i for i, char in enumerate(content) for _ in char.casefold()] # folded index -> content index
+    chars = list(content)
+    for matcher in matchers:
+        for match in matcher.finditer(folded):
+            if match.end() > match.start():
+                for i in range(origin[match.start()], origin[match.end() - 1] + 1):
+                    chars[i] = '*'
+    return ''.join(chars)
+
+class Rules:
+    """Compiled rules from one version of the moderation file"""
+    def __init__(self, doc: kdl.Document):
+        words = {action: set() for action in ACTIONS}
+        patterns = {action: [] for action in ACTIONS} # joined into one regex
+        separate = {action: [] for action in ACTIONS} # compiled on their own
+        self.duplicate_window = 0
+        self.duplicate_max = 0
+        for node in doc.nodes:
+            action = node.props.get("action", "block")
+            if action not in ACTIONS:
+                raise ValueError(f"Unknown moderation action: {action}")
+            match node.name:
+                case "words":
+                    words[action].update(str(i).casefold() for i in node.args if str(i))
+                case "pattern":
+                    pattern = node.args[0]
+                    compiled = re.compile(pattern) # report a bad rule on its own, not as part of the combined regex
+                    if GLOBAL_FLAGS.match(pattern):
+                        raise ValueError(f"Global flags would apply to every rule, use a scoped group like (?i:...): {pattern}")
+                    if compiled.groupindex or GROUP_REFERENCE.search(pattern):
+                        separate[action].append(compiled)
+                    else:
+                        patterns[action].append(pattern)
+                case "duplicates":
+                    self.duplicate_window = float(node.props.get("window", 30))
+                    self.duplicate_max = int(node.props.get("max", 3))
+
+        self.rule_count = sum(len(i) for i in words.values()) + sum(len(i) + len(separate[a]) for a, i in patterns.items())
+        self.matchers = {} # action: regexes for casefolded text, the joined one first
+        for action in ACTIONS:
+            parts = [f"(?:{i})" for i in patterns[action]]
+            if words[action]:
+                parts.append(rf"(?<!\w){trie_pattern(words[action])}(?!\w)")
+            matchers = ([re.compile('|'.join(parts))] if parts else []) + separate[action]
+            if matchers:
+                self.matchers[action] = tuple(matchers)
+
+class Moderation:
+    """Checks messages against the rules in path, reloading them when the file changes.
+    Recent messages per sender are kept in an LRU of at most max_senders entries for duplicate detection."""
+    def __init__(self, path: str, reload_interval: float = 2, max_senders: int = 10000):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.max_senders = max_senders
+        self.recent = OrderedDict() # sender key: (content, first seen, times seen)
+        self.rules = Rules(kdl.Document()) # nothing is blocked until start() loads the file
+        self.mtime = None
+        self._task = None
+
+    def reload(self) -> bool:
+        """Recompile the rules if the file changed. A broken file is logged and the old rules kept."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+
+        self.mtime = mtime
+        try:
+            with open(self.path, 'r') as infile:
+                rules = Rules(kdl.parse(infile.read()))
+        except Exception as e:
+            logger.error("Moderation rules in {} not loaded: {}", self.path, e)
+            return False
+
+        self.rules = rules
+        logger.info("Loaded {} moderation rules from {}", rules.rule_count, self.path)
+        return True
+
+    def start(self):
+        self.reload()
+        if self.reload_interval > 0:
+            self._task = asyncio.create_task(self._watch())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            # Compiling thousands of rules takes a while; check() keeps using the old ones until they are swapped in
+            await asyncio.to_thread(self.reload)
+
+    def check(self, sender: str, content: str) -> tuple[str | None, str]:
+        """Returns (reason the message is blocked or None, content with masked words starred out)"""
+        rules = self.rules
+        folded = content.casefold()
+        if any(matcher.search(folded) for matcher in rules.matchers.get("block", ())):
+            metrics.moderation_total.inc("block")
+            return ("Message blocked", content)
+
+        if rules.duplicate_max and self.is_duplicate(sender.casefold(), folded, rules):
+            metrics.moderation_total.inc("duplicate")
+            return ("Duplicate message", content)
+
+        matchers = rules.matchers.get("mask", ())
+        if any(matcher.search(folded) for matcher in matchers):
+            metrics.moderation_total.inc("mask")
+            content = mask(content, folded, matchers)
+        return (None, content)
+
+    def is_duplicate(self, key: str, text: str, rules: Rules) -> bool:
+        """Has this sender sent text more than duplicate_max times in a row within duplicate_window seconds?"""
+        now = time.monotonic()
+        last = self.recent.get(key)
+        if last and last[0] == text and now - last[1] < rules.duplicate_window:
+            entry = (text, last[1], last[2] + 1)
+        else:
+            entry = (text, now, 1)
+        self.recent[key] = entry
+        self.recent.move_to_end(key)
+        if len(self.recent) > self.max_senders:
+            self.recent.popitem(last=False)
+        return entry[2] > rules.duplicate_max
@@ -0,0 +1,60 @@
+import time
+from db import Store, BatchWriter
+
+class OfflineQueue(Store):
+    """Direct messages to registered users who were offline, keyed by recipient UUID.
+
+    Writes go through a BatchWriter. Each recipient keeps at most `limit` messages (oldest dropped first)
+    and messages older than ttl seconds are purged as batches are written."""
+    def __init__(self, path: str = "data/server.db", limit: int = 100, ttl: float = 7 * 24 * 3600,
+                 max_batch: int = 256, max_delay: float = 0.05):
+        super().__init__(path)
+        self.limit = limit
+        self.ttl = ttl
+        self.writer = BatchWriter(self._write_batch, max_batch, max_delay, "offline_write")
+
+    def migrate(self):
+        db = self.db
+        db.execute("""CREATE TABLE IF NOT EXISTS offline_dm (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient VARCHAR NOT NULL,
+            ts INTEGER NOT NULL,
+            source VARCHAR NOT NULL,
+            content VARCHAR NOT NULL)""")
+        db.execute("CREATE INDEX IF NOT EXISTS offline_dm_recipient ON offline_dm (recipient, id)")
+        db.commit()
+
+    def start(self):
+        self.writer.start()
+
+    async def close(self):
+        await self.writer.close()
+
+    def add(self, recipient: str, source: str, content: str):
+        self.writer.add(("add", recipient, int(time.time()), source, content))
+
+    def remove(self, ids: list[int]):
+        """Forget delivered messages"""
+        self.writer.add(("remove", ids))
+
+    def fetch(self, recipient: str) -> list[tuple]:
+        """Unexpired messages for recipient as (id, ts, source, content), oldest first"""
+        return self.db.execute("SELECT id, ts, source, content FROM offline_dm WHERE recipient = ? AND ts >= ? ORDER BY id LIMIT ?",
+                               (recipient, int(time.time() - self.ttl), self.limit)).fetchall()
+
+    def _write_batch(self, rows: list):
+        db = self.db
+        recipients = set()
+        for row in rows:
+            match row[0]:
+                case "add":
+                    db.execute("INSERT INTO offline_dm (recipient, ts, source, content) VALUES (?, ?, ?, ?)", row[1:])
+                    recipients.add(row[1])
+                case "remove":
+                    db.executemany("DELETE FROM offline_dm WHERE id = ?", ((i,) for i in row[1]))
+
+        for recipient in recipients: # keep only the newest `limit` per recipient
+            db.execute("""DELETE FROM offline_dm WHERE recipient = ? AND id NOT IN (
+                SELECT id FROM offline_dm WHERE recipient = ? ORDER BY id DESC LIMIT ?)""", (recipient, recipient, self.limit))
+        db.execute("DELETE FROM offline_dm WHERE ts < ?", (int(time.time() - self.ttl),))
+        db.commit()
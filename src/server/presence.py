@@ -0,0 +1,84 @@
+import asyncio
+import sys
+from collections import deque
+from SCPC.util import packets
+from fanout import fanout
+from common import roster
+
+class Presence:
+    """Versioned roster of who is online, pushed to subscribed clients as snapshot-then-deltas.
+
+    join() and leave() only record the change. Changes are applied together once per window seconds as one
+    new version, and every subscriber gets a single roster delta for it, so a reconnect storm of N users
+    costs each subscriber a handful of frames instead of N connect packets. The last `history` versions are
+    kept so a client that missed some deltas can catch up with one merged delta instead of a full snapshot."""
+    def __init__(self, window: float = 0.1, history: int = 256):
+        self.window = window
+        self.version = 0
+        self.online = {} # casefolded nick: nick, as of self.version
+        self.changes = {} # casefolded nick: (nick, online) waiting for the next version
+        self.log = deque(maxlen=history) # (version, ((key, nick, online), ...))
+        self.subscribers = set() # outboxes
+        self._flush_handle = None
+
+    def __len__(self):
+        return len(self.online)
+
+    def join(self, nick: str):
+        self._change(nick, True)
+
+    def leave(self, nick: str):
+        self._change(nick, False)
+
+    def _change(self, nick: str, online: bool):
+        self.changes[sys.intern(nick.casefold())] = (nick, online) # the same key string as in the nick registry
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        """Apply pending changes as a new version and send the delta to every subscriber"""
+        self._flush_handle = None
+        changes, self.changes = self.changes, {}
+        applied = []
+        for key, (nick, online) in changes.items():
+            if online != (key in self.online) or (online and self.online[key] != nick):
+                applied.append((key, nick, online))
+                if online:
+                    self.online[key] = nick
+                else:
+                    del self.online[key]
+        if not applied:
+            return
+
+        base = self.version
+        self.version += 1
+        self.log.append((self.version, tuple(applied)))
+        added = [nick for _, nick, online in applied if online]
+        removed = [nick for _, nick, online in applied if not online]
+        fanout(self.delta(base, added, removed).encode(), self.subscribers, "roster")
+
+    def delta(self, base: int, added: list[str], removed: list[str]) -> packets.Packet:
+        return packets.clientbound.roster(version=self.version, base=base, added=roster.pack(added), removed=roster.pack(removed))
+
+    def snapshot(self) -> packets.Packet:
+        """The whole roster (base 0 means "replace what you have")"""
+        return self.delta(0, list(self.online.values()), [])
+
+    def since(self, version: int) -> packets.Packet:
+        """One delta taking a client from version to the current version, or a snapshot if that is too far back"""
+        if version == self.version:
+            return self.delta(version, [], [])
+        oldest = self.log[0][0] - 1 if self.log else self.version # earliest version we can build a delta from
+        if version == 0 or not oldest <= version < self.version:
+            return self.snapshot()
+
+        first, last = {}, {} # key: online before version / after the latest one
+        for entry_version, applied in self.log:
+            if entry_version <= version:
+                continue
+            for key, nick, online in applied:
+                first.setdefault(key, not online)
+                last[key] = (nick, online)
+        added = [nick for key, (nick, online) in last.items() if online]
+        removed = [nick for key, (nick, online) in last.items() if not online and first[key]]
+        return self.delta(version, added, removed)
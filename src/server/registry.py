@@ -0,0 +1,42 @@
+import sys
+
+class NickRegistry:
+    """Connected clients keyed by casefolded nickname.
+
+    Lookup, claim and release are all O(1). None of the methods await, so a claim can't be interleaved
+    with another one on the event loop."""
+    def __init__(self):
+        self._by_nick = {} # {"nick": <Client>}
+
+    @staticmethod
+    def key(nick: str) -> str:
+        return nick.casefold()
+
+    def __len__(self):
+        return len(self._by_nick)
+
+    def __contains__(self, client) -> bool:
+        return self._by_nick.get(self.key(client.nick)) is client
+
+    def __iter__(self):
+        return iter(self._by_nick.values())
+
+    def get(self, nick: str):
+        """Return the client using nick, or None"""
+        return self._by_nick.get(self.key(nick))
+
+    def claim(self, nick: str, client) -> bool:
+        """Reserve nick for client. Returns False if someone else already holds it."""
+        holder = self._by_nick.setdefault(sys.intern(self.key(nick)), client)
+        return holder is client
+
+    def release(self, client, nick: str | None = None) -> bool:
+        """Free nick (default: client.nick) if client holds it. Returns False if client didn't hold it."""
+        key = self.key(client.nick if nick is None else nick)
+        if self._by_nick.get(key) is client:
+            del self._by_nick[key]
+            return True
+        return False
+
+    def values(self):
+        return self._by_nick.values()
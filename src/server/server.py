@@ -1,175 +1,780 @@
+import time
+STARTED = time.perf_counter() # start of the import phase
 import asyncio
+import argparse
+import os
+import random
+import signal
+import socket
+import sys
+from contextlib import contextmanager
 import websockets
+import kdl
 from loguru import logger
 from SCPC.util import packets
-from auth import User
-from common.conn import ConnectionHandler
+from auth import AuthService, store as user_store
+import commands
+from hashing import PasswordHasher
+import fanout as fanout_mod
+from fanout import Outbox, fanout
+import metrics
+from keepalive import KeepAlive, rtt_ms
+from presence import Presence
+from registry import NickRegistry
+from channels import ChannelIndex
+from cluster import BusClient, run_cluster
+from sessions import SessionStore
+from supervisor import LISTEN_FD_ENV, READY_FD_ENV, SUPERVISED_ENV
+from offline import OfflineQueue
+from moderation import Moderation
+from history import HistoryStore, KIND_MESSAGE, KIND_EMOTE, KIND_DIRECT
+from common.conn import ConnectionHandler, packet_handler
+from common.ratelimit import RateLimiter, TokenBucket, limits_from_config
+from common.gen_utils import config_node, config_section
+from common import cmd_utils, logs, paths, schema, transport
 
 MAX_MESSAGE_SIZE=100
 SERVER_ADDRESS="0.0.0.0"
 SERVER_PORT="6974"
 
-command_aliases = {"msg" : "message"}
-
-clients = []
-
-packets.init("etc/cfg/packets.kdl")
-
-async def broadcast(packet: packets.Packet):
-    #logger.info("Broadcasting message: {}", message)
-    if clients:
-        await asyncio.gather(*[client.send(packet) for client in clients])
+clients = NickRegistry()
+commands.server = sys.modules[__name__]
+channels = ChannelIndex()
+bus: BusClient | None = None # set when running as one worker of a cluster
+app: "App | None" = None
+
+packets.init(paths.PACKETS_PATH)
+
+# Load config file
+with open(paths.CONFIG_PATH, 'r') as _infile:
+    server_cfg = kdl.parse(_infile.read())
+
+_outbound_cfg = config_section(server_cfg, "server", "outbound")
+OUTBOUND_QUEUE_SIZE = int(_outbound_cfg.get("queue_size", 256))
+OUTBOUND_POLICY = _outbound_cfg.get("policy", "drop_oldest")
+
+# The largest inbound packet is a full-length message (up to 4 bytes per character) plus its other fields
+TRANSPORT_OPTIONS = transport.options(config_section(server_cfg, "server", "transport"), server=True, max_size=MAX_MESSAGE_SIZE * 4 + 1024)
+
+_batching_cfg = config_section(server_cfg, "server", "batching")
+BATCHING_ENABLED = bool(_batching_cfg.get("enabled", False))
+BATCH_WINDOW = float(_batching_cfg.get("window_ms", 5)) / 1000
+BATCH_MAX_EVENTS = int(_batching_cfg.get("max_events", 32))
+DM_SPEC = schema.load()["clientbound"]["direct_message"]
+BATCHABLE = {name: spec for name, spec in schema.load()["clientbound"].items() if name in ("recieve_message", "emote", "connect", "disconnect")}
+
+_auth_cfg = config_section(server_cfg, "server", "auth")
+AUTH_HASH_TARGET_MS = float(_auth_cfg.get("target_ms", 0))
+_sessions_cfg = config_section(server_cfg, "server", "sessions")
+REQUIRE_LOGIN = bool(_sessions_cfg.get("require_login", False))
+sessions = SessionStore("data/server.db", float(_sessions_cfg.get("ttl_hours", 168)) * 3600, int(_sessions_cfg.get("cache", 10000)))
+_global_limit, CONNECTION_LIMIT, PACKET_LIMITS = limits_from_config(config_node(server_cfg, "server", "ratelimit"))
+global_bucket = TokenBucket(*_global_limit) if _global_limit else None
+
+_admins = config_node(server_cfg, "server", "admins")
+ADMINS = set(_admins.args) if _admins is not None else set()
+
+_history_cfg = config_section(server_cfg, "server", "history")
+HISTORY_PAGE_SIZE = int(_history_cfg.get("page_size", 100))
+history = HistoryStore(_history_cfg.get("path", "data/history.db"), int(_history_cfg.get("batch", 256)), float(_history_cfg.get("flush_ms", 50)) / 1000)
+
+_offline_cfg = config_section(server_cfg, "server", "offline")
+OFFLINE_FRAME_EVENTS = int(_offline_cfg.get("frame_events", 32))
+offline = OfflineQueue("data/server.db", int(_offline_cfg.get("limit", 100)), float(_offline_cfg.get("ttl_hours", 168)) * 3600)
+
+_logging_cfg = config_section(server_cfg, "server", "logging")
+LOG_LEVEL = _logging_cfg.get("level", "INFO")
+sample_message_log = logs.sampler(int(_logging_cfg.get("message_sample", 1)))
+
+_metrics_cfg = config_section(server_cfg, "server", "metrics")
+METRICS_ADDRESS = _metrics_cfg.get("address", "127.0.0.1")
+METRICS_PORT = int(_metrics_cfg.get("port", 0))
+
+metrics.registry.add(metrics.CallbackGauge("pychat_clients", "Fully connected clients on this process", lambda: len(clients)))
+metrics.registry.add(metrics.CallbackGauge("pychat_channels", "Channels with at least one member", lambda: len(channels)))
+metrics.registry.add(metrics.CallbackGauge("pychat_outbound_queued_frames", "Frames waiting in all outboxes", lambda: sum(len(i.outbox) for i in clients)))
+metrics.registry.add(metrics.CallbackGauge("pychat_outbound_max_queue_depth", "Deepest outbox", lambda: max((len(i.outbox) for i in clients), default=0)))
+metrics.registry.add(metrics.CallbackGauge("pychat_outbound_dropped_frames", "Frames dropped by full outboxes since startup", lambda: fanout_mod.dropped_total))
+metrics.registry.add(metrics.CallbackGauge("pychat_log_dropped_messages", "Log messages dropped by a full log queue since startup", logs.dropped))
+
+_presence_cfg = config_section(server_cfg, "server", "presence")
+presence = Presence(float(_presence_cfg.get("window_ms", 100)) / 1000, int(_presence_cfg.get("history", 256)))
+PRESENCE_EVENTS = ("connect", "disconnect") # replaced by roster deltas for presence subscribers
+
+background_tasks = set() # tasks started from sync code, referenced until done so they can't be garbage collected
+
+def spawn(coro, name: str) -> asyncio.Task:
+    """Run coro as a background task whose failure is logged instead of never being retrieved"""
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(_task_done)
+    return task
+
+def _task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.opt(exception=task.exception()).error("Background task {} failed", task.get_name())
+
+def send_keep_alive(client, stamp: int):
+    client.outbox.push(packets.clientbound.keep_alive(timestamp=stamp).encode(), "keep_alive")
+
+def reap(client, reason: str):
+    logger.info("Dropping {} ({}): {}", client.nick or "unconnected client", client.addr, reason)
+    spawn(client.disconnect(reason), "reap")
+
+_restart_cfg = config_section(server_cfg, "server", "restart")
+RESTART_DELAY = (float(_restart_cfg.get("min_delay", 1)), float(_restart_cfg.get("max_delay", 15)))
+RESTART_DRAIN_TIMEOUT = float(_restart_cfg.get("drain_timeout", 5))
+RESTART_READY_TIMEOUT = float(_restart_cfg.get("ready_timeout", 30))
+
+_keepalive_cfg = config_section(server_cfg, "server", "keepalive")
+keepalive = KeepAlive(send_keep_alive, reap, float(_keepalive_cfg.get("interval", 30)), int(_keepalive_cfg.get("misses", 3)),
+                      float(_keepalive_cfg.get("idle_limit", 0)), int(_keepalive_cfg.get("slots", 64)))
+
+_moderation_cfg = config_section(server_cfg, "server", "moderation")
+moderation = Moderation(paths.resolve(_moderation_cfg.get("path", "etc/cfg/moderation.kdl")), float(_moderation_cfg.get("reload_s", 2)),
+                        int(_moderation_cfg.get("senders", 10000)))
+
+auth = AuthService(int(_auth_cfg.get("workers", 0)) or None, PasswordHasher(_auth_cfg.get("hasher", "scrypt")))
+
+def audience(channel: str = ""):
+    """Clients who should see traffic in channel ("" is the lobby, which is everyone)"""
+    return channels.members(channel) if channel else clients
+
+async def broadcast(packet: packets.Packet, channel: str = ""):
+    """Encode packet once and queue the same bytes on the outbox of everyone in channel"""
+    start = time.perf_counter()
+    data = packet.encode()
+    spec = BATCHABLE.get(packet.type_name)
+    record = schema.batch_record(packet, spec) if spec else None
+    sent = fanout(data, recipients(packet.type_name, channel), packet.type_name, record)
+    if bus:
+        bus.publish(data, packet.type_name, channel, record)
+    metrics.broadcast_seconds.observe(time.perf_counter() - start)
+    metrics.broadcast_fanout.observe(sent)
+
+def encode_batch(records: list[str]) -> bytes:
+    return packets.clientbound.batch(events=schema.RECORD_SEP.join(records)).encode()
+
+def printable(*values: str) -> bool:
+    """Batch records use control characters as separators, so nothing a client sends may contain one"""
+    return all(i.isprintable() for i in values)
+
+def recipients(type_name: str, channel: str = ""):
+    """Outboxes of everyone in channel who should get a broadcast of this packet type"""
+    if type_name in PRESENCE_EVENTS:
+        return (client.outbox for client in audience(channel) if not client.presence)
+    return (client.outbox for client in audience(channel))
+
+def on_bus_broadcast(data: bytes, key: str, channel: str, record: str | None = None):
+    if key in PRESENCE_EVENTS and record: # keep our roster in step with the other workers
+        _, nickname, _ = record.split(schema.FIELD_SEP)
+        presence.join(nickname) if key == "connect" else presence.leave(nickname)
+    fanout(data, recipients(key, channel), key, record)
+
+def on_bus_presence(online: list[str], offline: list[str]):
+    """Users on the other workers when we join the bus, and those of a worker that died"""
+    for nick in online:
+        presence.join(nick)
+    for nick in offline:
+        dc_pkt = packets.clientbound.disconnect(nickname=nick, message="Server worker stopped")
+        on_bus_broadcast(dc_pkt.encode(), "disconnect", "", schema.batch_record(dc_pkt, BATCHABLE["disconnect"]))
+
+def on_bus_deliver(target: str, data: bytes):
+    client = clients.get(target)
+    if client is not None:
+        client.outbox.push(data, "direct_message")
+        if client.user:
+            dm = packets.decode(data)
+            history.append(KIND_DIRECT, dm.source, dm.content, target, target_user=client.user)
+
+async def claim_nick(nick: str, client) -> bool:
+    """Claim nick locally and, in cluster mode, across every worker"""
+    if not clients.claim(nick, client):
+        return False
+    if bus and clients.key(nick) != clients.key(client.nick) and not await bus.claim(nick):
+        clients.release(client, nick)
+        return False
+    return True
+
+def release_nick(client):
+    if clients.release(client) and bus:
+        bus.release(client.nick)
 
 
 class Client(ConnectionHandler):
     """Class to store Client attributes and methods"""
+    __slots__ = ("channels", "permissions", "outbox", "last_seen", "last_active", "rtt", "offline_checked", "presence")
+    inbound = ("serverbound", "twoway")
+
     def __init__(self, conn: websockets.ClientConnection, nick: str = ""):
         super().__init__(conn, nick)
-
-    def if_fully_connected(func):
-        async def wrapper(self, *args, **kwargs):
-            # Is the client fully connected? (has sent the connect packet)
-            if not self.fully_connected:
-                error_packet = packets.twoway.response(value=127, content="Client connection not complete")
-                await self.send(error_packet)
-                return
-            return await func(self, *args, **kwargs)
-        return wrapper
+        self.channels = set() # casefolded names of joined channels
+        self.permissions = frozenset() # shared empty set until granted something
+        self.outbox = Outbox(conn, OUTBOUND_QUEUE_SIZE, OUTBOUND_POLICY, on_overflow=self.on_outbox_overflow)
+        self.rate_limiter = RateLimiter(CONNECTION_LIMIT, PACKET_LIMITS, global_bucket)
+        self.last_seen = self.last_active = time.monotonic()
+        self.rtt = None # ms, from the last answered keep-alive
+        self.offline_checked = False
+        self.presence = False # gets roster deltas instead of connect/disconnect packets
+
+    async def send(self, packet: packets.Packet):
+        """Queue a reply to this connection, waiting for room. Frames for other connections use outbox.push()."""
+        await self.outbox.put(packet.encode(), packet.type_name)
+
+    async def handle_packet(self, packet: packets.Packet):
+        self.last_seen = time.monotonic()
+        if packet.type_name != "response": # answering keep-alives doesn't count as activity
+            self.last_active = self.last_seen
+        start = time.perf_counter()
+        await super().handle_packet(packet)
+        metrics.packets_total.inc(packet.type_name)
+        metrics.packet_seconds.observe(time.perf_counter() - start, packet.type_name)
+
+    def on_outbox_overflow(self):
+        logger.info("User {} is not keeping up with outbound traffic, disconnecting", self.nick)
+        spawn(self.disconnect("Too slow"), "disconnect slow client")
 
     async def disconnect(self, message: str):
+        if not self.is_connected:
+            return (0, "")
+        self.is_connected = False
+
+        release_nick(self)
+        channels.part_all(self)
+        keepalive.remove(self)
+        presence.subscribers.discard(self.outbox)
+        if self.fully_connected: presence.leave(self.nick)
+
+        message = ''.join(i for i in message if i.isprintable())
         dc_pkt = packets.clientbound.disconnect(nickname=self.nick, message=message)
         if self.fully_connected: await broadcast(dc_pkt)
-        logger.info(f"User {self.nick} disconnected: {message}")
+        logger.info("User {} disconnected: {}", self.nick, message)
+        self.outbox.abort()
         await self.conn.close()
-        self.is_connected = False
         return (0, "")
 
     async def p_connect(self, packet: packets.Packet):
-        for client in clients:
-            if client.nick.lower() == packet.nickname.lower():
-                return (5, "Username already in use")
-        self.nick = packet.nickname
-        clients.append(self)
+        if REQUIRE_LOGIN and self.user is None:
+            return (10, "Not logged in")
+        if not printable(packet.nickname):
+            return (13, "Invalid characters")
+        if not await claim_nick(packet.nickname, self):
+            return (5, "Username already in use")
+        if self.fully_connected and clients.key(self.nick) != clients.key(packet.nickname):
+            release_nick(self) # reconnecting under a new nickname
+            presence.leave(self.nick)
+        self.nick = sys.intern(packet.nickname) # one string for this nick however many places hold it
         self.fully_connected = True
+        if BATCHING_ENABLED and packet.features & schema.FEATURE_BATCH:
+            self.outbox.enable_batching(encode_batch, BATCH_MAX_EVENTS, BATCH_WINDOW)
+        if packet.features & schema.FEATURE_PRESENCE and not self.presence:
+            self.presence = True
+            # No await between the snapshot and subscribing, so no delta can fall in between
+            self.outbox.push(presence.snapshot().encode(), "roster")
+            presence.subscribers.add(self.outbox)
+        presence.join(self.nick)
 
         con_pkt = packets.clientbound.connect(nickname=self.nick)
         await broadcast(con_pkt)
-        logger.info(f"User {self.nick} connected")
+        logger.info("User {} connected", self.nick)
+        self.check_offline()
         return (0, "Connected")
 
-    @if_fully_connected
+    @packet_handler(fully_connected=True)
     async def p_send_message(self, packet: packets.Packet):
         if len(packet.content) > MAX_MESSAGE_SIZE:
-            logger.info(f"Message from {self.nick} blocked (too long)")
+            logger.info("Message from {} blocked (too long)", self.nick)
             return (1, "Message too long")
 
         if len(packet.content) == 0:
-            logger.info(f"Message from {self.nick} blocked (empty)")
+            logger.info("Message from {} blocked (empty)", self.nick)
             return (4, "Empty message")
 
-        logger.debug(f"Received message from {self.nick}: {packet.content}")
-        msg_pkt = packets.clientbound.recieve_message(nickname=self.nick, content=packet.content)
-        await broadcast(msg_pkt)
+        if not printable(packet.content, packet.channel):
+            return (13, "Invalid characters")
+
+        if packet.channel and channels.key(packet.channel) not in self.channels:
+            return (7, "Not in channel")
+
+        reason, content = moderation.check(self.nick, packet.content)
+        if reason:
+            logger.info("Message from {} blocked ({})", self.nick, reason.lower())
+            return (14, reason)
+
+        if logs.enabled("DEBUG") and sample_message_log():
+            logger.debug("Received message from {}: {}", self.nick, content)
+        msg_pkt = packets.clientbound.recieve_message(channel=channels.name(packet.channel), nickname=self.nick, content=content)
+        await broadcast(msg_pkt, packet.channel)
+        history.append(KIND_MESSAGE, self.nick, content, channels.key(packet.channel))
         return (0, "Sent")
 
-    @if_fully_connected
+    @packet_handler(fully_connected=True)
     async def p_emote(self, packet: packets.Packet):
         #TODO: Convert to server command
         if len(packet.content) > MAX_MESSAGE_SIZE:
-            logger.info(f"Message from {self.nick} blocked (too long)")
+            logger.info("Message from {} blocked (too long)", self.nick)
             return (1, "Message too long")
 
         if len(packet.content) == 0:
-            logger.info(f"Message from {self.nick} blocked (empty)")
+            logger.info("Message from {} blocked (empty)", self.nick)
             return (4, "Empty message")
 
-        logger.debug(f"Received emote from {self.nick}: {packet.content}")
-        msg_pkt = packets.clientbound.emote(nickname=self.nick, content=packet.content)
-        await broadcast(msg_pkt)
+        if not printable(packet.content, packet.channel):
+            return (13, "Invalid characters")
+
+        if packet.channel and channels.key(packet.channel) not in self.channels:
+            return (7, "Not in channel")
+
+        reason, content = moderation.check(self.nick, packet.content)
+        if reason:
+            logger.info("Emote from {} blocked ({})", self.nick, reason.lower())
+            return (14, reason)
+
+        if logs.enabled("DEBUG") and sample_message_log():
+            logger.debug("Received emote from {}: {}", self.nick, content)
+        msg_pkt = packets.clientbound.emote(channel=channels.name(packet.channel), nickname=self.nick, content=content)
+        await broadcast(msg_pkt, packet.channel)
+        history.append(KIND_EMOTE, self.nick, content, channels.key(packet.channel))
         return (0, "Sent")
 
-    @if_fully_connected
+    @packet_handler(fully_connected=True)
     async def p_command(self, packet: packets.Packet):
         command_text = packet.keyword
-        logger.info(f"Command executed by {self.nick}: {command_text}")
+        logger.info("Command executed by {}: {}", self.nick, command_text)
         return await self.handle_command(packet.keyword, packet.args)
 
-    @if_fully_connected
+    @packet_handler(fully_connected=True)
     async def p_direct_message(self, packet: packets.Packet):
         if len(packet.content) > MAX_MESSAGE_SIZE:
-            logger.info(f"Message from {self.nick} blocked (too long)")
+            logger.info("Message from {} blocked (too long)", self.nick)
             return (1, "Message too long")
 
-        for client in clients:
-            if client.nick.lower() == packet.target.lower():
-                dm_packet = packets.clientbound.direct_message(source=self.nick, content=packet.content)
-                await client.send(dm_packet)
-                return (0, "Sent")
-        return (2, "Target user not found")
+        if not printable(packet.content):
+            return (13, "Invalid characters")
+
+        reason, content = moderation.check(self.nick, packet.content)
+        if reason:
+            logger.info("Direct message from {} blocked ({})", self.nick, reason.lower())
+            return (14, reason)
+
+        dm_packet = packets.clientbound.direct_message(source=self.nick, content=content)
+        client = clients.get(packet.target)
+        if client is not None:
+            # push, not put: waiting on someone else's full outbox would stall our own packet loop
+            client.outbox.push(dm_packet.encode(), "direct_message")
+            history.append(KIND_DIRECT, self.nick, content, packet.target, self.user, client.user)
+        elif bus and await bus.direct(packet.target, dm_packet.encode()):
+            # The recipient's worker logs its own copy for them, see on_bus_deliver
+            history.append(KIND_DIRECT, self.nick, content, packet.target, self.user)
+        else:
+            recipient = await auth.uuid_of(packet.target)
+            if recipient is None:
+                return (2, "Target user not found")
+            offline.add(recipient, self.nick, content)
+            history.append(KIND_DIRECT, self.nick, content, packet.target, self.user, packet.target)
+            return (0, "User is offline, message will be delivered when they log in")
+        return (0, "Sent")
+
+    @packet_handler(fully_connected=True)
+    async def p_fetch_history(self, packet: packets.Packet):
+        """Send up to packet.count entries older than the packet.before cursor (0 = newest).
+        The response content is the cursor for the next page, or 0 if there is nothing older."""
+        count = min(packet.count, HISTORY_PAGE_SIZE)
+        with metrics.timer(metrics.db_seconds, "history_fetch"):
+            rows = await asyncio.to_thread(history.fetch, self.user, packet.before, count, tuple(self.channels))
+        for seq, ts, kind, source, target, content in rows:
+            # put() waits for room in our own outbox, so a big backfill never displaces live traffic,
+            # and its frames are kept, so live traffic can't evict them and leave a gap in the page
+            await self.send(packets.clientbound.history(seq=seq, timestamp=ts, kind=kind, nickname=source, target=target, content=content))
+
+        cursor = rows[0][0] if rows and len(rows) == count else 0
+        return (0, str(cursor))
+
+    @packet_handler(fully_connected=True)
+    async def p_join(self, packet: packets.Packet):
+        if not channels.valid_name(packet.channel):
+            return (8, "Invalid channel name")
+        if not channels.join(packet.channel, self):
+            return (0, "Already in channel")
+        logger.info("User {} joined {}", self.nick, packet.channel)
+        return (0, "Joined")
+
+    @packet_handler(fully_connected=True)
+    async def p_part(self, packet: packets.Packet):
+        if not channels.part(packet.channel, self):
+            return (7, "Not in channel")
+        logger.info("User {} left {}", self.nick, packet.channel)
+        return (0, "Left")
+
+    async def p_response(self, packet: packets.Packet):
+        """Answer to a keep-alive, with its timestamp echoed back as the content"""
+        if packet.content.isdigit():
+            self.rtt = rtt_ms(int(packet.content))
+            metrics.keepalive_rtt_seconds.observe(self.rtt / 1000)
+
+    @packet_handler(fully_connected=True)
+    async def p_sync_roster(self, packet: packets.Packet):
+        """Catch up from packet.version after missing roster deltas"""
+        if not self.presence:
+            return (12, "Presence was not requested on connect")
+        await self.send(presence.since(packet.version))
+        return (0, str(presence.version))
 
     async def p_disconnect(self, packet: packets.Packet):
         await self.disconnect(packet.message)
 
     async def p_register(self, packet: packets.Packet):
-        response = User.register(packet.username, packet.password)
+        response = await auth.register(packet.username, packet.password)
         if response:
             return (0, response.content)
         else:
             return(99, response.content)
 
     async def p_login(self, packet: packets.Packet):
-        response = User.login(packet.username, packet.password)
+        response = await auth.login(packet.username, packet.password)
         if response:
+            self.bind_user(packet.username)
+            token, expires = sessions.issue(packet.username)
+            await self.send(packets.clientbound.session(token=token, expires=expires))
             return (0, response.content)
         else:
             return(99, response.content)
 
-    async def handle_command(self, keyword: str, args: str) -> bool:
-        cmd = args.split(' ')
+    async def p_resume(self, packet: packets.Packet):
+        """Log in with a session token from an earlier login. No password hashing or database lookup for cached sessions."""
+        username = await sessions.resolve(packet.token)
+        if username is None:
+            return (99, "Invalid or expired session")
+        self.bind_user(username)
+        logger.info("User {} resumed a session", username)
+        return (0, username)
+
+    def bind_user(self, username: str):
+        self.user = username
+        if username in ADMINS:
+            self.permissions |= {"admin"}
+        self.check_offline()
+
+    def check_offline(self):
+        """Once the connection is both logged in and fully connected, start delivering its queued DMs"""
+        if self.user and self.fully_connected and not self.offline_checked:
+            self.offline_checked = True
+            spawn(self.deliver_offline(), "deliver offline messages")
+
+    async def deliver_offline(self):
+        """Send the DMs queued while this user was offline, up to OFFLINE_FRAME_EVENTS per frame. Runs as its own
+        task and waits for room in our own outbox, so a long backlog never holds up packet handling or displaces live traffic."""
+        recipient = await auth.uuid_of(self.user)
+        if recipient is None:
+            return
+        with metrics.timer(metrics.db_seconds, "offline_fetch"):
+            rows = await asyncio.to_thread(offline.fetch, recipient)
+
+        delivered = []
+        for start in range(0, len(rows), OFFLINE_FRAME_EVENTS):
+            chunk = rows[start:start + OFFLINE_FRAME_EVENTS]
+            dms = [packets.clientbound.direct_message(source=source, content=content) for _, _, source, content in chunk]
+            if self.outbox.encode_batch and len(dms) > 1:
+                sent = await self.outbox.put(self.outbox.encode_batch([schema.batch_record(i, DM_SPEC) for i in dms]), "batch")
+            else:
+                for dm in dms:
+                    if not (sent := await self.outbox.put(dm.encode(), "direct_message")):
+                        break
+            if not sent:
+                break
+            delivered.extend(row[0] for row in chunk)
+
+        if delivered:
+            offline.remove(delivered)
+            logger.info("Delivered {} offline messages to {}", len(delivered), self.nick)
+
+    async def handle_command(self, keyword: str, args: str) -> tuple[int, str]:
+        cmd_class = commands.resolve(keyword)
+        if cmd_class is None:
+            return (3, "Command not found")
+
+        if cmd_class.permission and cmd_class.permission not in self.permissions:
+            return (11, "Permission denied")
 
-        if keyword in command_aliases.keys():
-            keyword = command_aliases[keyword] # set to value section of alias
+        # The command packet itself already used one token
+        if cmd_class.cost > 1 and self.rate_limiter and not self.rate_limiter.allow("command", cmd_class.cost - 1):
+            return (6, "Rate limited")
 
         try:
-            cmd_func = getattr(self, "c_" + keyword) # Find the function in self that's named 'c_commandname'
-        except AttributeError: # command not found
-            return (3, "Command not found")
+            cmd_args = cmd_class.parse_args(cmd_utils.split_args(args))
+        except cmd_utils.CommandArgumentError:
+            return (12, f"Usage: {cmd_class.usage}")
 
-        await cmd_func(keyword, cmd)
-        return (0, "Executed")
+        return await cmd_class.invoke(self, cmd_class.keyword, **cmd_args) or (0, "Executed")
 
 async def chat_handler(websocket: websockets.ClientConnection):
     client = Client(websocket)
-    async for message_packet in websocket: # wait for packets and decode raw bytes back to text
+    client.outbox.start()
+    keepalive.add(client)
+    try:
+        async for message_packet in websocket: # wait for packets and decode raw bytes back to text
+            try:
+                message = packets.decode(message_packet)
+            except Exception as e:
+                logger.warning("Error while reading packet from {}: {}", client.nick, e.args)
+            else:
+                await client.handle_packet(message)
+    except websockets.ConnectionClosedError:
+        pass # closed with an error or service restart code, or without a close frame. Clean up all the same.
+    finally: # also when a handler raised, so the nick, channels and roster entry aren't left behind
+        release_nick(client)
+        channels.part_all(client)
+        keepalive.remove(client)
+
+        if client.is_connected:
+            await client.disconnect("Connection closed")
+        client.outbox.close()
+
+class App:
+    """One server process. Starts its subsystems in timed phases and stops them in reverse.
+
+    Only what is needed to accept connections runs before listening. Opening the databases and tuning
+    the password hash cost happen in the background afterwards: stores open lazily on first use anyway,
+    and logins before tuning finishes use the hasher's minimum cost.
+
+    SIGHUP restarts without dropping the listening socket: a new process is started with the socket's fd
+    in $PYCHAT_LISTEN_FD and, once it is listening, this one stops accepting, asks its clients to reconnect
+    after a random delay and drains their outboxes before exiting. New connections queue in the shared
+    socket's backlog meanwhile, so none are refused. SIGTERM does the same minus the new process.
+    Under supervisor.py ($PYCHAT_SUPERVISED) the supervisor owns the socket and starts the new process itself."""
+    def __init__(self, worker_id: int | None = None, bus_path: str | None = None):
+        self.worker_id = worker_id
+        self.bus_path = bus_path
+        self.timings = {} # phase: seconds
+        self.tasks = []
+        self.server = None
+        self.metrics_server = None
+        self.stopping = False
+        self.restarting = False
+        self.supervised = bool(os.environ.pop(SUPERVISED_ENV, None))
+        self.finished = asyncio.Event() # set once clients are drained after SIGHUP/SIGTERM
+        self._record("import", time.perf_counter() - STARTED)
+
+    def _record(self, name: str, seconds: float):
+        self.timings[name] = seconds
+        metrics.startup_seconds.set(seconds, name)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
         try:
-            message = packets.decode(message_packet)
+            yield
+        finally:
+            self._record(name, time.perf_counter() - start)
+
+    def report(self, *names: str) -> str:
+        return ', '.join(f"{name} {self.timings[name] * 1000:.1f}ms" for name in names if name in self.timings)
+
+    async def start(self):
+        global bus
+        if self.bus_path:
+            with self.phase("bus"):
+                bus = BusClient(self.worker_id, on_bus_broadcast, on_bus_deliver, on_bus_presence)
+                await bus.connect(self.bus_path)
+
+        with self.phase("subsystems"):
+            history.start()
+            sessions.start()
+            offline.start()
+            keepalive.start()
+            moderation.start()
+            self.tasks.append(asyncio.create_task(metrics.monitor_loop_lag()))
+            if METRICS_PORT:
+                # Workers of a cluster each get their own port
+                try:
+                    self.metrics_server = await metrics.serve(METRICS_ADDRESS, METRICS_PORT + (self.worker_id or 0))
+                except OSError:
+                    if not self.supervised:
+                        raise
+                    self.tasks.append(asyncio.create_task(self.serve_metrics_later()))
+
+        with self.phase("listen"):
+            listen_fd = os.environ.pop(LISTEN_FD_ENV, None)
+            if listen_fd:
+                self.server = await websockets.serve(chat_handler, sock=socket.socket(fileno=int(listen_fd)), **TRANSPORT_OPTIONS)
+            else:
+                self.server = await websockets.serve(chat_handler, SERVER_ADDRESS, SERVER_PORT, reuse_port=bus is not None, **TRANSPORT_OPTIONS)
+        ready_fd = os.environ.pop(READY_FD_ENV, None)
+        if ready_fd:
+            os.write(int(ready_fd), b"1")
+            os.close(int(ready_fd))
+
+        self._record("ready", time.perf_counter() - STARTED)
+        logger.info("Server started on {}:{}, accepting connections after {:.1f}ms ({})", SERVER_ADDRESS, SERVER_PORT,
+                    self.timings["ready"] * 1000, self.report("import", "bus", "subsystems", "listen"))
+        self.tasks.append(asyncio.create_task(self.warm_up()))
+
+        loop = asyncio.get_running_loop()
+        if hasattr(signal, "SIGHUP"): # not on Windows
+            loop.add_signal_handler(signal.SIGTERM, lambda: self.tasks.append(asyncio.create_task(self.shutdown())))
+            if not self.bus_path and not self.supervised: # cluster workers bind their own sockets with SO_REUSEPORT
+                loop.add_signal_handler(signal.SIGHUP, lambda: self.tasks.append(asyncio.create_task(self.restart())))
+
+    async def serve_metrics_later(self):
+        """Bind the metrics port once the server the supervisor is replacing has let go of it"""
+        while True:
+            await asyncio.sleep(1)
+            try:
+                self.metrics_server = await metrics.serve(METRICS_ADDRESS, METRICS_PORT)
+                return
+            except OSError:
+                pass
+
+    async def warm_up(self):
+        """Startup work that doesn't need to finish before accepting connections"""
+        try:
+            with self.phase("databases"):
+                await asyncio.gather(*(asyncio.to_thread(store.open) for store in (user_store, history, sessions, offline)))
+            if AUTH_HASH_TARGET_MS:
+                with self.phase("auth_tune"):
+                    await auth.tune(AUTH_HASH_TARGET_MS)
         except Exception as e:
-            logger.warning(f"Error while reading packet from {client.nick}: {e.args}")
+            logger.error("Background startup failed: {}", e)
         else:
-            await client.handle_packet(message)
-
-    # once client disconnected
-    if client in clients:
-        clients.remove(client)
-
-    if client.is_connected:
-        await client.disconnect("Connection closed")
-
-async def main():
-    logger.info(f"Starting server on {SERVER_ADDRESS}:{SERVER_PORT}")
-    async with websockets.serve(chat_handler, SERVER_ADDRESS, SERVER_PORT):
-        logger.info("Server started. Waiting for connections...")
-        await asyncio.Future()  # Run forever
+            logger.info("Background startup finished ({})", self.report("databases", "auth_tune"))
+
+    async def restart(self):
+        """Start a new server process on our listening socket, then drain our clients and exit"""
+        if self.stopping or self.restarting or self.server is None:
+            return
+        self.restarting = True
+        logger.info("Restarting: starting a new server process")
+        listen_fd = self.server.sockets[0].fileno()
+        read_fd, write_fd = os.pipe()
+        if self.metrics_server: # the new process binds the metrics port
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        process = None
+        try:
+            process = await asyncio.create_subprocess_exec(sys.executable, *sys.orig_argv[1:], pass_fds=(listen_fd, write_fd),
+                                                           env={**os.environ, LISTEN_FD_ENV: str(listen_fd), READY_FD_ENV: str(write_fd)})
+            os.close(write_fd)
+            write_fd = None
+            ready = await self._wait_ready(read_fd)
+        except OSError as e:
+            logger.error("Could not start the new server process: {}", e)
+            ready = False
+        finally:
+            if write_fd is not None:
+                os.close(write_fd)
+            os.close(read_fd)
+
+        if not ready:
+            logger.error("New server process did not start listening, restart abandoned")
+            if process is not None:
+                # Don't leave it to start listening later, as a second server with its own nick registry on our socket
+                await self._stop_process(process)
+            self.restarting = False
+            if METRICS_PORT:
+                self.metrics_server = await metrics.serve(METRICS_ADDRESS, METRICS_PORT)
+            return
+        logger.info("New server process is listening, handing over")
+        await self.shutdown()
+
+    async def _stop_process(self, process: asyncio.subprocess.Process):
+        """Terminate a new server process we gave up on and reap it"""
+        if process.returncode is None:
+            process.terminate() # if it got as far as listening, SIGTERM drains whoever it accepted
+            try:
+                await asyncio.wait_for(process.wait(), RESTART_DRAIN_TIMEOUT + 5)
+            except asyncio.TimeoutError:
+                process.kill()
+        await process.wait()
+
+    async def _wait_ready(self, read_fd: int) -> bool:
+        """Wait for the new process to write to the ready pipe. It closing the pipe (by exiting) means it failed."""
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(read_fd, lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, RESTART_READY_TIMEOUT)
+            return os.read(read_fd, 1) == b"1"
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(read_fd)
+
+    async def shutdown(self):
+        """Stop accepting connections, tell clients when to reconnect and drain their outboxes, then let run() exit"""
+        if self.stopping:
+            return
+        self.stopping = True
+        if self.server:
+            self.server.close(close_connections=False) # only our copy of the socket; a new process keeps listening on it
+        connected = list(clients)
+        logger.info("Shutting down, asking {} clients to reconnect", len(connected))
+        for client in connected:
+            delay = random.uniform(*RESTART_DELAY) # spread out the reconnects and the logins that come with them
+            client.outbox.push(packets.clientbound.reconnect(delay_ms=int(delay * 1000), message="Server restarting").encode(), "reconnect")
+        await asyncio.gather(*(client.outbox.drain(RESTART_DRAIN_TIMEOUT) for client in connected))
+        if self.server: # including connections that never sent connect
+            await asyncio.gather(*(conn.close(websockets.CloseCode.SERVICE_RESTART, "Server restarting") for conn in self.server.connections),
+                                 return_exceptions=True)
+        self.finished.set()
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        keepalive.stop()
+        moderation.stop()
+        for task in self.tasks:
+            task.cancel()
+        if self.metrics_server:
+            self.metrics_server.close()
+        await history.close()
+        await sessions.close()
+        await offline.close()
+
+    async def run(self):
+        try:
+            await self.start()
+            await self.finished.wait()
+        finally:
+            await self.stop()
+
+async def main(worker_id: int | None = None, bus_path: str | None = None):
+    global app
+    app = App(worker_id, bus_path)
+    await app.run()
+
+def run_worker(worker_id: int, bus_path: str):
+    logs.setup(LOG_LEVEL)
+    logger.info("Worker {} starting", worker_id)
+    try:
+        asyncio.run(main(worker_id, bus_path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logs.shutdown()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    _cluster_cfg = config_section(server_cfg, "server", "cluster")
+    parser.add_argument("-w", "--workers", type=int, default=int(_cluster_cfg.get("workers", 1)),
+                        help="Number of worker processes sharing the port (1 = single process)")
+    args = parser.parse_args()
+    logs.setup(LOG_LEVEL)
+
     try:
-        asyncio.run(main())
+        if args.workers > 1:
+            run_cluster(args.workers, run_worker, int(float(_cluster_cfg.get("bus_buffer_mb", 16)) * 2 ** 20))
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Server stopped by user")
     except OSError as e:
-        logger.error(f"Service already running on that address: \nOnly one use of each socket address is normally permitted.\n(Address: {SERVER_ADDRESS}:{SERVER_PORT} is already in use)\nIs the server already running?\n")
+        logger.error("Service already running on that address: \nOnly one use of each socket address is normally permitted.\n(Address: {}:{} is already in use)\nIs the server already running?\n", SERVER_ADDRESS, SERVER_PORT)
     except Exception as e:
-        logger.error(f"Server stopped due to error: {e}")
+        logger.error("Server stopped due to error: {}", e)
+    finally:
+        logs.shutdown()
 
 
 
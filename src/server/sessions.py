@@ -0,0 +1,86 @@
+import asyncio
+import hashlib
+import secrets
+import time
+from collections import OrderedDict
+from db import Store, BatchWriter
+
+class SessionStore(Store):
+    """Session tokens handed out at login, so a reconnecting client can resume without its password.
+
+    Tokens live in an LRU cache of up to `capacity` entries, so resuming is a dict lookup. Every token is
+    also written (through a BatchWriter) to SQLite, which is only read when a token isn't cached, e.g.
+    after a restart. Only a hash of each token is stored."""
+    def __init__(self, path: str = "data/server.db", ttl: float = 7 * 24 * 3600, capacity: int = 10000):
+        super().__init__(path)
+        self.ttl = ttl
+        self.capacity = capacity
+        self.cache = OrderedDict() # token hash: (username, expires)
+        self.writer = BatchWriter(self._write_batch, name="session_write")
+
+    def migrate(self):
+        db = self.db
+        db.execute("""CREATE TABLE IF NOT EXISTS sessions (
+            token VARCHAR PRIMARY KEY,
+            username VARCHAR NOT NULL,
+            expires INTEGER NOT NULL)""")
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+        db.commit()
+
+    def start(self):
+        self.writer.start()
+
+    async def close(self):
+        await self.writer.close()
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def _remember(self, key: str, username: str, expires: int):
+        self.cache[key] = (username, expires)
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+
+    def issue(self, username: str) -> tuple[str, int]:
+        """Create a session for username. Returns (token, expiry as a unix timestamp)."""
+        token = secrets.token_urlsafe(32)
+        expires = int(time.time() + self.ttl)
+        key = self._key(token)
+        self._remember(key, username, expires)
+        self.writer.add((key, username, expires))
+        return token, expires
+
+    async def resolve(self, token: str) -> str | None:
+        """Username the session token belongs to, or None if it is unknown or expired"""
+        key = self._key(token)
+        entry = self.cache.get(key)
+        if entry is None:
+            entry = await asyncio.to_thread(self._load, key)
+            if entry is None:
+                return None
+        username, expires = entry
+        if expires < time.time():
+            self.revoke(token)
+            return None
+        self._remember(key, username, expires)
+        return username
+
+    def revoke(self, token: str):
+        key = self._key(token)
+        self.cache.pop(key, None)
+        self.writer.add((key, None, 0))
+
+    def _load(self, key: str) -> tuple[str, int] | None:
+        return self.db.execute("SELECT username, expires FROM sessions WHERE token = ?", (key,)).fetchone()
+
+    def _write_batch(self, rows: list):
+        db = self.db
+        for key, username, expires in rows: # in order, so a revoke after an issue in the same batch wins
+            if username is None:
+                db.execute("DELETE FROM sessions WHERE token = ?", (key,))
+            else:
+                db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (key, username, expires))
+        db.execute("DELETE FROM sessions WHERE expires < ?", (int(time.time()),))
+        db.commit()
@@ -0,0 +1,166 @@
+"""Zero-downtime restarts where the server can't replace itself, e.g. as a container's main process.
+
+A server restarting on SIGHUP starts its successor as a child and exits, which stops a container whose
+main process it is (taking the successor with it). The supervisor runs as that main process instead: it
+owns the listening socket and starts one server process on it. On SIGHUP it starts a new server on the
+same socket and, once that is listening, sends the old one SIGTERM, which asks its clients to reconnect
+and drains them. SIGTERM and SIGINT are passed on to the server, and the supervisor exits with the
+server's exit code when it stops, so the container's restart policy still applies.
+
+    python3 src/server/supervisor.py [server arguments]
+
+Servers are started in single process mode: cluster workers bind their own sockets with SO_REUSEPORT."""
+import asyncio
+import os
+import signal
+import socket
+import sys
+import kdl
+from loguru import logger
+from common.gen_utils import config_section
+from common import logs, paths
+
+LISTEN_FD_ENV = "PYCHAT_LISTEN_FD" # listening socket inherited from the process being replaced
+READY_FD_ENV = "PYCHAT_READY_FD" # pipe to tell that process we are listening
+SUPERVISED_ENV = "PYCHAT_SUPERVISED" # set for servers started here: SIGHUP is handled by the supervisor
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+SERVER_ADDRESS = "0.0.0.0" # the same as server.py
+SERVER_PORT = 6974
+
+async def wait_ready(read_fd: int, timeout: float) -> bool:
+    """Wait for the new process to write to the ready pipe. It closing the pipe (by exiting) means it failed."""
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+    loop.add_reader(read_fd, lambda: readable.done() or readable.set_result(None))
+    try:
+        await asyncio.wait_for(readable, timeout)
+        return os.read(read_fd, 1) == b"1"
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        loop.remove_reader(read_fd)
+
+async def stop_process(process: asyncio.subprocess.Process, timeout: float):
+    """SIGTERM process (which drains its clients), killing it if it takes more than timeout seconds, and reap it"""
+    if process.returncode is None:
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+    await process.wait()
+
+class Supervisor:
+    """Keeps one server process listening on sock, replacing it on SIGHUP"""
+    def __init__(self, sock: socket.socket, args: list[str], ready_timeout: float, drain_timeout: float):
+        self.sock = sock
+        self.args = args
+        self.ready_timeout = ready_timeout
+        self.drain_timeout = drain_timeout
+        self.current: asyncio.subprocess.Process | None = None
+        self.retiring = set() # replaced servers still draining their clients
+        self.restarting = False
+        self.stopping = False
+
+    async def start_server(self) -> asyncio.subprocess.Process | None:
+        """Start a server process on our socket. Returns it once it is listening, or None if it didn't get there."""
+        listen_fd = self.sock.fileno()
+        read_fd, write_fd = os.pipe()
+        process = None
+        try:
+            process = await asyncio.create_subprocess_exec(sys.executable, SERVER_PATH, *self.args, "--workers", "1",
+                                                           pass_fds=(listen_fd, write_fd),
+                                                           env={**os.environ, LISTEN_FD_ENV: str(listen_fd), READY_FD_ENV: str(write_fd), SUPERVISED_ENV: "1"})
+            os.close(write_fd)
+            write_fd = None
+            ready = await wait_ready(read_fd, self.ready_timeout)
+        except OSError as e:
+            logger.error("Could not start a server process: {}", e)
+            ready = False
+        finally:
+            if write_fd is not None:
+                os.close(write_fd)
+            os.close(read_fd)
+        if ready:
+            return process
+        if process is not None:
+            # Don't leave it to start listening later, as a second server with its own nick registry on our socket
+            await stop_process(process, self.drain_timeout + 5)
+        return None
+
+    async def restart(self):
+        """Start a new server, then retire the current one"""
+        if self.stopping or self.restarting:
+            return
+        self.restarting = True
+        try:
+            logger.info("Restarting: starting a new server process")
+            process = await self.start_server()
+            if process is None:
+                logger.error("New server process did not start listening, restart abandoned")
+                return
+            if self.stopping: # SIGTERM while it was starting
+                await stop_process(process, self.drain_timeout + 5)
+                return
+            logger.info("New server process {} is listening, retiring {}", process.pid, self.current.pid)
+            old, self.current = self.current, process
+            self.retiring.add(old)
+            await stop_process(old, self.drain_timeout + 5)
+            self.retiring.discard(old)
+        finally:
+            self.restarting = False
+
+    async def stop(self):
+        """Pass SIGTERM on to every server"""
+        self.stopping = True
+        for process in (self.current, *self.retiring):
+            if process.returncode is None:
+                process.terminate()
+
+    async def run(self) -> int:
+        """Supervise until the current server exits, returning its exit code"""
+        self.current = await self.start_server()
+        if self.current is None:
+            logger.error("Server process did not start listening")
+            return 1
+        logger.info("Supervising server process {} on {}:{}", self.current.pid, *self.sock.getsockname()[:2])
+
+        loop = asyncio.get_running_loop()
+        tasks = set()
+        def spawn(coro):
+            task = asyncio.create_task(coro)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        loop.add_signal_handler(signal.SIGHUP, lambda: spawn(self.restart()))
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, lambda: spawn(self.stop()))
+
+        while True:
+            process = self.current
+            code = await process.wait()
+            if process is self.current: # not replaced while we waited
+                break
+        if not self.stopping:
+            logger.error("Server process {} exited with code {}", process.pid, code)
+        for old in list(self.retiring):
+            await old.wait()
+        return code
+
+def main():
+    with open(paths.CONFIG_PATH, 'r') as infile:
+        cfg = kdl.parse(infile.read())
+    logs.setup(config_section(cfg, "server", "logging").get("level", "INFO"))
+    restart_cfg = config_section(cfg, "server", "restart")
+    try:
+        sock = socket.create_server((SERVER_ADDRESS, SERVER_PORT))
+        sock.set_inheritable(True)
+        supervisor = Supervisor(sock, sys.argv[1:], float(restart_cfg.get("ready_timeout", 30)), float(restart_cfg.get("drain_timeout", 5)))
+        return asyncio.run(supervisor.run())
+    except OSError as e:
+        logger.error("Could not listen on {}:{}: {}", SERVER_ADDRESS, SERVER_PORT, e)
+        return 1
+    finally:
+        logs.shutdown()
+
+if __name__ == "__main__":
+    sys.exit(main())